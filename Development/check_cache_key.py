@@ -0,0 +1,27 @@
+import numpy as np
+
+from Tool.functions import ScenarioCache
+
+
+def check_cache_key():
+    """ Changing any single value of the inputs that processed scenarios depend on must change the cache key """
+    applications = np.random.RandomState(0).uniform(0, 10, (100, 11))
+    chemicals = [(1.0, True, 0.01, applications)]
+    key = ScenarioCache.key('07', chemicals)
+
+    changed = applications.copy()
+    changed[57, 6] += 1e-9
+    assert ScenarioCache.key('07', [(1.0, True, 0.01, changed)]) != key, "Change to one application not detected"
+    assert ScenarioCache.key('07', [(1.000000001, True, 0.01, applications)]) != key, "Change to Koc not detected"
+    assert ScenarioCache.key('07', [(1.0, True, 0.01, applications.astype(np.float32))]) != key, \
+        "Change of application dtype not detected"
+    assert ScenarioCache.key('07', [(1.0, True, 0.01, applications.copy())]) == key, "Equal inputs give different keys"
+    print("Cache keys distinguish single value changes")
+
+
+def main():
+    check_cache_key()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import sys
+
+import numpy as np
+
+from Tool.parameters import paths as p
+from Tool.functions import InputParams, Hydroregion, Scenarios, Recipes, Outputs, initialize, release_workspace
+
+# Tolerance of the float32 pipeline relative to float64 (see precision_params in Tool/parameters.py)
+relative_tolerance = 1e-3  # Concentrations, relative to the float64 value
+concentration_floor = 1e-6  # Concentrations below this fraction of the peak are not compared
+exceedance_tolerance = 1  # Exceedance probabilities, in years of exceedance
+
+
+def run(input_data, float_type):
+    """ Run the pesticide calculator for the first region in the inputs and return the output object """
+    inputs = InputParams(dict(input_data, float_type=float_type))
+    region_id = inputs.active_regions[0]
+    region = Hydroregion(region_id, inputs.sim_type, p.map_path, p.flow_dir, p.upstream_path, p.lakefile_path,
+                         p.geometry_path)
+    scenarios = Scenarios(inputs, region_id, p.input_scenario_path, region.active_reaches)
+    outputs = Outputs(inputs, scenarios.names, p.output_path, region.geometry, region.feature_type)
+    for year in [2011]:
+        recipes = Recipes(inputs, outputs, year, region, scenarios, p.output_path, region.active_reaches)
+        recipes.process_region()
+    return outputs
+
+
+def check_precision(input_data):
+    """ Run the inputs in double and single precision and return True if the outputs agree within tolerance """
+    run_workspace = initialize()
+    try:
+        double, single = (run(input_data, float_type) for float_type in ("float64", "float32"))
+
+        # Compare concentration time series
+        field = double.output_fields.index('total_conc')
+        reference = np.array(double.time_series.reader)[:, :, field]
+        test = np.array(single.time_series.reader)[:, :, field]
+        compared = np.abs(reference) > concentration_floor * np.abs(reference).max()
+        if not compared.any():
+            print("Concentration: no values above the floor to compare")
+            return False
+        concentration_error = (np.abs(test - reference)[compared] / np.abs(reference[compared])).max()
+        print("Concentration: max relative error {:.2e} (tolerance {:.0e})".format(concentration_error,
+                                                                                   relative_tolerance))
+
+        # Compare exceedance probabilities
+        n_years = double.i.year_index.max()
+        exceedance_error = \
+            np.abs(np.array(single.exceedances.reader) - np.array(double.exceedances.reader)).max() * n_years
+        print("Exceedances: max error {:.2f} years (tolerance {})".format(exceedance_error, exceedance_tolerance))
+    finally:
+        release_workspace(run_workspace)
+
+    return concentration_error <= relative_tolerance and exceedance_error <= exceedance_tolerance
+
+
+def main():
+    from Tool.chemicals import atrazine_demo
+    if not check_precision(atrazine_demo):
+        print("float32 results are outside tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
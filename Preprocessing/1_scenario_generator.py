@@ -6,7 +6,7 @@ import numpy as np
 import re
 from numba import njit
 
-from Tool.functions import MemoryMatrix, RecipeMap
+from Tool.functions import MemoryMatrix, MatrixContainer, RecipeMap
 from utilities import nhd_states, slope_range, uslep_values, matrix_fields, types, increments_1, increments_2, delta_x
 
 
@@ -54,8 +54,10 @@ class InputMatrix(pd.DataFrame):
 
 class MetfileMatrix(MemoryMatrix):
     def __init__(self, memmap_path):
+        self.container_path = memmap_path + ".mtx"
         self.path = memmap_path + ".dat"
         self.keyfile_path = memmap_path + "_key.npy"
+        self.offset = 0
 
         # Set row/column offsets
         self.start_date, self.end_date, self.metfiles = self.load_key()
@@ -66,9 +68,17 @@ class MetfileMatrix(MemoryMatrix):
         self.new_years = np.arange(self.start_date, self.end_date + np.timedelta64(365, 'D'),
                                    np.timedelta64(1, 'Y'), dtype='datetime64[Y]').astype('datetime64[D]')
         # Initialize memory matrix
-        super(MetfileMatrix, self).__init__([self.metfiles, self.n_dates, 3], path=self.path, existing=True)
+        super(MetfileMatrix, self).__init__([self.metfiles, self.n_dates, 3], path=self.path, existing=True,
+                                            offset=self.offset)
 
     def load_key(self):
+        if os.path.exists(self.container_path):
+            container = MatrixContainer(self.container_path)
+            self.path, self.offset = self.container_path, container.offset
+            self.label_order = container.table('order')
+            start_date, end_date = map(np.datetime64, (container.attributes['start_date'],
+                                                       container.attributes['end_date']))
+            return start_date, end_date, container.labels
         try:
             data = np.load(self.keyfile_path)
             start_date, end_date = map(np.datetime64, data[:2])
@@ -116,11 +126,13 @@ class OutputMatrix(object):
             # f.write(",".join(map(str, list(self.array_matrix.shape) + list(self.variable_matrix.shape))))
 
     def populate(self):
-        for i, row in enumerate(self.in_matrix.iterate_rows(report=1000)):
-            s = Scenario(row, self.met)
-            if s.valid:
-                self.array_matrix.update(s.scenario, s.arrays)
-                self.variable_matrix.update(s.scenario, s.vars)
+        # Rows are staged and written to the matrices in bulk, with the remainder written when the loop ends
+        with self.array_matrix.buffered() as arrays, self.variable_matrix.buffered() as variables:
+            for i, row in enumerate(self.in_matrix.iterate_rows(report=1000)):
+                s = Scenario(row, self.met)
+                if s.valid:
+                    arrays.update(s.scenario, s.arrays)
+                    variables.update(s.scenario, s.vars)
 
 
 class Scenario(object):
@@ -0,0 +1,35 @@
+import os
+
+from Tool.functions import MemoryMatrix, CompressedMatrix
+from Preprocessing.utilities import nhd_states
+
+
+def load_key(keyfile_path):
+    """ Read the array labels, scenario IDs and number of dates from a scenario key file """
+    with open(keyfile_path) as f:
+        arrays, _, scenarios = (next(f).strip().split(",") for _ in range(3))
+        next(f)
+        n_dates = int(next(f).strip().split(",")[2])
+    return arrays, scenarios, n_dates
+
+
+def compress_scenarios(scenario_path, block_rows=64, codec='zlib'):
+    """ Write a compressed copy of a region's scenario arrays, which is read by Scenarios in place of the raw file """
+    if os.path.exists(scenario_path + "_arrays.mtx"):
+        source = MemoryMatrix.load(scenario_path + "_arrays.mtx")
+    else:
+        arrays, scenarios, n_dates = load_key(scenario_path + "_key.txt")
+        source = MemoryMatrix([scenarios, arrays, n_dates], path=scenario_path + "_arrays.dat", existing=True)
+    compressed = CompressedMatrix.create(source, scenario_path + "_arrays.zdat", block_rows, codec)
+    raw_size, compressed_size = os.path.getsize(source.path), os.path.getsize(compressed.path)
+    print("{}: {:.1f} MB -> {:.1f} MB".format(scenario_path, raw_size / 1e6, compressed_size / 1e6))
+
+
+def main():
+    scenario_path = os.path.join("..", "bin", "Preprocessed", "Scenarios", "region_{}")
+    for region in nhd_states.keys():
+        if any(os.path.exists(scenario_path.format(region) + ext) for ext in ("_arrays.mtx", "_arrays.dat")):
+            compress_scenarios(scenario_path.format(region))
+
+
+main()
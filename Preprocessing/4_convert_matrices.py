@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+from Tool.functions import MatrixContainer
+from Tool.parameters import paths
+from Preprocessing.utilities import nhd_states
+
+
+def copy_rows(source, container, chunk=1000):
+    """ Copy a matrix into the data block of a new container, a chunk of rows at a time """
+    out_array = np.memmap(container.path, dtype=container.dtype, mode='r+', offset=container.offset,
+                          shape=container.shape)
+    for start in range(0, container.shape[0], chunk):
+        out_array[start:start + chunk] = source[start:start + chunk]
+    out_array.flush()
+
+
+def convert_scenarios(scenario_path):
+    """ Convert a region's scenario arrays and variables, described by a text key file, into matrix containers """
+    with open(scenario_path + "_key.txt") as f:
+        arrays, variables, scenarios = (next(f).strip().split(",") for _ in range(3))
+        start_date = next(f).strip()
+        shape = [int(val) for val in next(f).strip().split(",")]
+    for name, shape, attributes in (("arrays", shape[:3], {'arrays': arrays, 'start_date': start_date}),
+                                    ("vars", shape[3:], {'variables': variables})):
+        source = np.memmap(scenario_path + "_{}.dat".format(name), dtype=np.float32, mode='r', shape=tuple(shape))
+        container = MatrixContainer.create(scenario_path + "_{}.mtx".format(name), shape, np.float32,
+                                           labels=np.array(scenarios), attributes=attributes)
+        copy_rows(source, container)
+
+
+def convert_recipe_map(recipe_path):
+    """ Convert a recipe map and its .npz key into a matrix container """
+    key = np.load(recipe_path + "_key.npz")
+    shape = tuple(key['shape'])
+    source = np.memmap(recipe_path + ".dat", dtype=np.int32, mode='r', shape=shape)
+    container = MatrixContainer.create(recipe_path + ".mtx", shape, np.int32,
+                                       tables={'map': np.int32(key['map']), 'scenarios': key['scenarios']})
+    copy_rows(source, container)
+
+
+def convert_geometry(flowline_path):
+    """ Convert a flowline geometry file and its .npz key into a matrix container """
+    key = np.load(flowline_path + "_key.npz")
+    shape = tuple(key['shape'])
+    source = np.memmap(flowline_path + ".dat", dtype=np.float32, mode='r', shape=shape)
+    container = MatrixContainer.create(flowline_path + ".mtx", shape, np.float32, tables={'map': key['map']})
+    copy_rows(source, container)
+
+
+def convert_metfiles(metfile_path):
+    """ Convert the met file matrix and its .npy key into a matrix container """
+    key = np.load(metfile_path + "_key.npy")
+    start_date, end_date, metfiles = key[0], key[1], key[2:]
+    n_dates = int((np.datetime64(end_date) - np.datetime64(start_date)).astype(int)) + 1
+    shape = (metfiles.size, n_dates, 3)
+    source = np.memmap(metfile_path + ".dat", dtype=np.float32, mode='r', shape=shape)
+    container = MatrixContainer.create(metfile_path + ".mtx", shape, np.float32, labels=metfiles,
+                                       attributes={'start_date': str(start_date), 'end_date': str(end_date)})
+    copy_rows(source, container)
+
+
+def main():
+    scenario_path = os.path.join(paths.input_scenario_path, "region_{}")
+    recipe_path = os.path.join(paths.map_path, "region_{}")
+    flowline_path = os.path.join(paths.geometry_path, "region_{}_flowlines")
+    metfile_path = os.path.join("..", "bin", "Preprocessed", "MetTables", "metfile")
+
+    for region in nhd_states.keys():
+        for path, convert, key in ((scenario_path, convert_scenarios, "_key.txt"),
+                                   (recipe_path, convert_recipe_map, "_key.npz"),
+                                   (flowline_path, convert_geometry, "_key.npz")):
+            if os.path.exists(path.format(region) + key):
+                print("Converting {}...".format(path.format(region)))
+                convert(path.format(region))
+    if os.path.exists(metfile_path + "_key.npy"):
+        convert_metfiles(metfile_path)
+
+
+main()
@@ -1,62 +1,327 @@
 import os
+import re
+import lzma
+import mmap
+import zlib
+import copy
 import json
 import math
+import atexit
+import shutil
+import struct
+import zipfile
+import weakref
+import hashlib
+import time
+import uuid
+import socket
 
 import numpy as np
 import pandas as pd
 
 from collections import Iterable, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 
 from tempfile import mkstemp
 from json import encoder
-from numba import guvectorize, njit
+import numba
+from numba import guvectorize, njit, prange
 import logging
-import tracemalloc
-from tracemalloc import Filter, Snapshot
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def replace_file(path, write):
+    """ Write a file by passing an open handle to write(), first to a temporary file in the same directory which is
+    then moved into place. Readers see either the old file or the complete new one, never a partial write """
+    handle, temp_path = mkstemp(suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class LabelIndex(object):
+    """ Resolves the labels of a matrix axis to rows. Labels are held as a sorted array and resolved with a binary
+    search. If a path is given, the sorted index is saved there and reused as long as it matches the labels """
+
+    def __init__(self, labels, path=None, order=None):
+        labels = np.asarray(labels)
+        if order is not None:  # Sort order stored with the labels
+            self.order = np.asarray(order)
+            self.sorted_labels = labels[self.order]
+            return
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path, allow_pickle=False) as index:
+                    self.sorted_labels, self.order = index['labels'], index['order']
+                if self.order.size == labels.size and np.array_equal(labels[self.order], self.sorted_labels):
+                    return
+            except (OSError, ValueError, KeyError, EOFError, IndexError, zipfile.BadZipFile):
+                pass  # An unreadable index is rebuilt
+        self.order = np.argsort(labels, kind='stable')
+        self.sorted_labels = labels[self.order]
+        if path is not None:
+            try:
+                replace_file(path, lambda f: np.savez(f, labels=self.sorted_labels, order=self.order))
+            except OSError:
+                pass
+
+    def __len__(self):
+        return self.order.size
+
+    def get(self, label, default=None):
+        row = self.rows(np.array([label]))[0]
+        return default if row < 0 else int(row)
+
+    def rows(self, labels):
+        """ Return the row of each label, or -1 for labels that are not found """
+        labels = np.asarray(labels)
+        if not self.order.size:
+            return np.full(labels.shape, -1, dtype=np.int64)
+        position = np.searchsorted(self.sorted_labels, labels).clip(0, self.order.size - 1)
+        return np.where(self.sorted_labels[position] == labels, self.order[position], -1)
+
+
+class MatrixContainer(object):
+    """
+    A matrix file which describes itself. A fixed binary header gives the format version, the dtype and shape of the
+    matrix and the location of its data, of a binary table of row labels and of a JSON block. The JSON block holds
+    attributes of the matrix and the location of any further tables, such as the sort order of the labels. Opening a
+    container reads only the header and the JSON block; labels and tables are mapped when they are first used.
+    The data start on a page boundary, so that they can be memory-mapped.
+    """
+    magic = b"SAMMATRX"
+    version = 1
+    # magic, version, number of dimensions, dtype, shape (up to 8 dimensions), data offset,
+    # label offset, label count, label dtype, JSON offset, JSON size
+    header = struct.Struct("<8sHH16s8QQQQ16sQQ")
+    data_offset = 4096
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            fields = self.header.unpack(f.read(self.header.size))
+            magic, version, n_dims, dtype = fields[:4]
+            if magic != self.magic:
+                raise ValueError("{} is not a matrix container".format(path))
+            elif version > self.version:
+                raise ValueError("Matrix container {} has unsupported version {}".format(path, version))
+            self.dtype = np.dtype(dtype.rstrip(b"\0").decode())
+            self.shape = tuple(int(d) for d in fields[4:4 + n_dims])
+            self.offset, self.label_offset, self.label_count, label_dtype, json_offset, json_size = fields[12:]
+            self.label_dtype = np.dtype(label_dtype.rstrip(b"\0").decode()) if self.label_count else None
+            f.seek(json_offset)
+            contents = json.loads(f.read(json_size).decode())
+        self.attributes = contents['attributes']
+        self.tables = contents['tables']
+        self._labels = None
 
-filters = [Filter(inclusive=True, filename_pattern="*requests*")]
-snapshots = []
-
-def collect_stats():
-    snapshots.append(tracemalloc.take_snapshot())
-    if len(snapshots) > 1:
-        stats = snapshots[-1].compare_to(snapshots[-2], 'lineno')
-
-        for stat in stats[:10]:
-            print(stat)
-            # print("{} new KiB {} total KiB {} new {} total memory blocks: ".format(stat.size_diff / 1024,
-            #                                                                        stat.size / 1024, stat.count_diff,
-            #                                                                        stat.count))
-            # for line in stat.traceback.format():
-            #     print(line)
+    @property
+    def labels(self):
+        if self._labels is None and self.label_dtype is not None:
+            self._labels = np.memmap(self.path, dtype=self.label_dtype, mode='r', offset=self.label_offset,
+                                     shape=(self.label_count,))
+        return self._labels
+
+    def table(self, name):
+        dtype, shape, offset = self.tables[name]
+        return np.memmap(self.path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=tuple(shape))
+
+    @classmethod
+    def create(cls, path, shape, dtype, labels=None, attributes=None, tables=None):
+        """ Write a new container with zeroed data. The sort order of the labels is stored as the table 'order' """
+        dtype = np.dtype(dtype)
+        tables = OrderedDict((name, cls.binary(table)) for name, table in (tables or {}).items())
+        if labels is not None:
+            labels = cls.binary(labels)
+            tables['order'] = np.argsort(labels, kind='stable')
+        data_size = int(np.prod(shape)) * dtype.itemsize
+        directory = {}
+        with open(path, 'wb') as f:
+            f.seek(cls.data_offset + data_size)
+            label_offset = cls.align(f)
+            if labels is not None:
+                f.write(labels.tobytes())
+            for name, table in tables.items():
+                directory[name] = (table.dtype.str, table.shape, cls.align(f))
+                f.write(table.tobytes())
+            json_offset = cls.align(f)
+            contents = json.dumps({'attributes': attributes or {}, 'tables': directory}).encode()
+            f.write(contents)
+            f.seek(0)
+            f.write(cls.header.pack(cls.magic, cls.version, len(shape), dtype.str.encode(),
+                                    *(tuple(shape) + (0,) * (8 - len(shape))), cls.data_offset, label_offset,
+                                    0 if labels is None else labels.size,
+                                    b"" if labels is None else labels.dtype.str.encode(), json_offset, len(contents)))
+        return cls(path)
+
+    @staticmethod
+    def binary(array):
+        """ Object arrays, such as labels read from older key files, are stored as fixed-width strings """
+        array = np.ascontiguousarray(array)
+        if array.dtype.kind == 'O':
+            array = array.astype(str)
+        return array
+
+    @staticmethod
+    def align(f, boundary=64):
+        """ Pad the file to the next boundary and return the position """
+        position = -(-f.tell() // boundary) * boundary
+        f.seek(position)
+        return position
 
 
 class MemoryMatrix(object):
-    """ A wrapper for NumPy 'memmap' functionality which allows the storage and recall of arrays from disk """
-
-    def __init__(self, dimensions, dtype=np.float32, path=None, existing=False):
+    """ A wrapper for NumPy 'memmap' functionality which allows the storage and recall of arrays from disk. The file is
+    mapped the first time it is accessed and the mapping is kept until the matrix is closed. A MemoryMatrix can be used
+    as a context manager which closes the matrix on exit.
+    Scratch matrices (no path given) may instead be held in process memory ('ram') or in shared memory ('shared'),
+    which other processes attach to when the matrix is passed to them. With 'auto', scratch matrices are held in
+    memory while they fit within the memory budget, and in temporary files otherwise """
+
+    mapping = None
+    read_ahead = False
+    backend = 'file'
+    shared = None
+    sparse = False
+    memory_used = 0  # Bytes of scratch matrices held in memory, across all matrices
+    buffer = None
+    offset = 0  # Position of the data in the matrix file
+    label_order = None
+    attributes = None
+    _lookup = None
+
+    def __init__(self, dimensions, dtype=np.float32, path=None, existing=False, read_ahead=False, backend=None,
+                 offset=0, sparse=False):
         self.dtype = dtype
         self.path = path
         self.existing = existing
+        self.read_ahead = read_ahead  # Advise the kernel of upcoming reads in fetch_multiple
+        self.offset = offset
+        self.sparse = sparse  # Only part of the matrix is expected to be written, so disk space is not reserved
 
-        # Initialize dimensions of array
-        self.dimensions = tuple(np.array(d) if isinstance(d, Iterable) else d for d in dimensions)
+        # Initialize dimensions of array. Labels are indexed when they are first looked up
+        self.dimensions = tuple(np.asarray(d) if isinstance(d, Iterable) else d for d in dimensions)
         self.labels = tuple(d if isinstance(d, Iterable) else None for d in self.dimensions)
         self.shape = tuple(int(d.size) if isinstance(d, Iterable) else d for d in self.dimensions)
-        self.lookup = None if self.labels[0] is None else dict(zip(self.labels[0], np.arange(self.shape[0])))
 
+        self.backend = self.select_backend(backend) if path is None and not existing else 'file'
         self.initialize_array()
 
+    @classmethod
+    def load(cls, path, **kwargs):
+        """ Open an existing MatrixContainer. The shape and dtype are read from its header """
+        container = MatrixContainer(path)
+        rows = container.shape[0] if container.labels is None else container.labels
+        matrix = cls((rows,) + container.shape[1:], container.dtype, path, existing=True, offset=container.offset,
+                     **kwargs)
+        matrix.attributes = container.attributes
+        if 'order' in container.tables:
+            matrix.label_order = container.table('order')
+        return matrix
+
+    @property
+    def lookup(self):
+        if self._lookup is None and self.labels[0] is not None:
+            self._lookup = LabelIndex(self.labels[0], self.path + ".labels.npz" if self.existing else None,
+                                      self.label_order)
+        return self._lookup
+
+    def select_backend(self, backend=None):
+        """ Choose where a scratch matrix is held, based on its size and the memory already in use """
+        from .parameters import matrix_storage
+
+        backend = backend or matrix_storage.backend
+        if backend != 'auto':
+            return backend
+        size = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+        if MemoryMatrix.memory_used + size > matrix_storage.memory_budget * 1024. ** 3:
+            return 'file'
+        elif os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free > size:
+            return 'shared'
+        else:
+            return 'ram'
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        # File mappings and shared memory are not passed to other processes, which open or attach to their own.
+        # Matrices held in process memory are copied. A buffered matrix is given an empty buffer of the same size
+        state = self.__dict__.copy()
+        if self.backend != 'ram':
+            state.pop('mapping', None)
+        state.pop('shared', None)
+        buffer = state.pop('buffer', None)
+        if buffer is not None:
+            state['buffer_size'] = buffer.size
+        return state
+
+    def __setstate__(self, state):
+        buffer_size = state.pop('buffer_size', None)
+        self.__dict__.update(state)
+        if self.backend == 'shared':
+            self.shared = SharedMemory(name=self.path)
+            self.mapping = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shared.buf)
+        if buffer_size is not None:
+            self.buffered(buffer_size)
+
+    def buffered(self, size=None):
+        """ Return a RowBuffer which stages updates to the matrix and writes them in bulk. The buffer holds 'size' rows,
+        or as many as fit in matrix_storage.write_buffer """
+        self.buffer = RowBuffer(self, size)
+        return self.buffer
+
+    def open(self):
+        """ Map the matrix file into memory, if not already mapped, and return the mapped array """
+        if self.buffer is not None and self.buffer.count:
+            self.buffer.flush()
+        if self.mapping is None:
+            mode = 'r+' if os.path.isfile(self.path) else 'w+'
+            self.mapping = np.memmap(self.path, dtype=self.dtype, mode=mode, shape=self.shape, offset=self.offset)
+        return self.mapping
+
+    def flush(self):
+        if self.buffer is not None:
+            self.buffer.flush()
+        if isinstance(self.mapping, np.memmap):
+            self.mapping.flush()
+
+    def close(self):
+        """ Flush any changes to disk and release the mapping. Matrices held in memory keep their data """
+        self.flush()
+        if self.backend == 'file':
+            self.mapping = None
+
     def fetch(self, index, aliased=False, copy=False, verbose=True):
-        array = self.copy if copy else self.reader
         try:
-            output = array[index if aliased else self.lookup.get(index)]
+            row = index if aliased else self.lookup.get(index)
+            if row is None:
+                raise IndexError
+            output = self.reader[row]
         except IndexError:
             if verbose:
                 print("{} not found".format(index))
             output = None
-        del array
+        else:
+            if copy:
+                output = np.array(output)
         return output
 
     def initialize_array(self):
@@ -66,59 +331,366 @@ class MemoryMatrix(object):
             if not os.path.exists(self.path):
                 raise Exception('Specified MemoryMatrix {} not found'.format(self.path))
 
+        # Scratch matrices held in memory are allocated here and released when the matrix is garbage collected
+        elif self.backend in ('ram', 'shared'):
+            size = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+            if self.backend == 'shared':
+                self.shared = SharedMemory(create=True, size=max(size, 1))
+                self.path = self.shared.name
+                self.mapping = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shared.buf)
+            else:
+                self.mapping = np.zeros(self.shape, dtype=self.dtype)
+            MemoryMatrix.memory_used += size
+            weakref.finalize(self, release_memory, size, self.shared)
+
         # If a path is given but not expected to exist, create a matrix at that location.
-        # Otherwise, use a temporary file
+        # Otherwise, use a temporary file in the scratch workspace of the run
         else:
             if self.path is None:
-                self.path = mkstemp(suffix=".dat", dir=os.path.join("..", "bin", "temp"))[1]
-            if not os.path.exists(self.path):
-                np.memmap(self.path, dtype=self.dtype, mode='w+', shape=self.shape)  # Allocate memory
-
-    def fetch_multiple(self, indices, copy=False, verbose=False, aliased=True, return_index=False, columns=None):
+                handle, self.path = mkstemp(suffix=".dat", dir=workspace())
+                os.close(handle)
+                self.allocate()
+            elif not os.path.exists(self.path):
+                self.allocate()
+
+    def allocate(self):
+        """ Size a new matrix file. Disk space for large files is reserved up front, so that a full disk is found
+        when the matrix is created rather than part way through writing it. Sparse matrices are left as sparse files,
+        which only take up space for the rows that are written """
+        from .parameters import matrix_storage
+
+        size = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+        with open(self.path, 'ab') as f:
+            f.truncate(size)
+            if not self.sparse and hasattr(os, 'posix_fallocate') and \
+                    0 < matrix_storage.preallocate * 1024. ** 2 <= size:
+                os.posix_fallocate(f.fileno(), 0, size)
+
+    def fetch_multiple(self, indices, copy=False, verbose=False, aliased=True, return_index=False, columns=None,
+                       dates=None):
 
         # If selecting by aliases, get indices for aliases
         index = None
         if aliased:
-            addresses = np.int32([self.lookup.get(x, -1) for x in indices])
+            addresses = self.lookup.rows(indices)
             found = np.where(addresses >= 0)[0]
             not_found = indices.size - found.size
             if not_found:
                 index = found
                 if verbose:
-                    print("Missing {} of {} indices in {} matrix".format(not_found, len(addresses), self.name))
+                    print("Missing {} of {} indices in {} matrix".format(not_found, len(addresses), self.path))
             indices = addresses[found]
 
-        # Fetch data from memory map
-        array = np.memmap(self.path, dtype='float32', mode='c' if copy else 'r+', shape=self.shape)
-        out_array = array[indices] if columns is None else array[np.ix_(indices, columns)]
-        del array
+        # Fetch data from memory map. Indexing by array always returns a copy
+        out_array = self.read_rows(np.asarray(indices, dtype=np.int64), columns, dates)
 
         if return_index:
             return out_array, index
         else:
             return out_array
 
+    def read_rows(self, indices, columns=None, dates=None):
+        """ Read rows in file order and return them in the order requested. Adjacent rows are merged into runs, which
+        are each read with a single sequential copy. A slice of the last axis may be given to read only those dates """
+        array = self.reader
+        rows, order = np.unique(indices, return_inverse=True)
+        run_starts, run_lengths = self.runs(rows)
+        if self.read_ahead:
+            self.advise(run_starts, run_lengths)
+        shape, window = self.selection(array.shape, columns, dates)
+
+        # Runs are only worth copying one at a time if most rows are adjacent to another
+        if run_starts.size * 2 > rows.size:
+            out_array = array[(rows,) + window] if columns is None else array[np.ix_(rows, columns) + window]
+        else:
+            out_array = np.empty((rows.size,) + shape, dtype=array.dtype)
+            position = 0
+            for start, length in zip(run_starts, run_lengths):
+                block = array[(slice(start, start + length),) + window]
+                out_array[position:position + length] = block if columns is None else block[:, columns]
+                position += length
+
+        # Scatter back into the requested order, unless the request was already sorted and unique
+        if rows.size == indices.size and np.array_equal(rows, indices):
+            return out_array
+        return out_array[order.ravel()]
+
+    @staticmethod
+    def selection(shape, columns=None, dates=None):
+        """ Shape of a row read with the given columns and dates, and the index of the dates within a row. Dates are
+        the last axis, so a date window can only be combined with columns if the matrix has an axis after them """
+        if dates is not None and columns is not None and len(shape) < 3:
+            raise ValueError("A matrix of shape {} has no date axis after its columns".format(shape))
+        row_shape = shape[1:] if columns is None else (len(columns),) + shape[2:]
+        if dates is None:
+            return row_shape, (Ellipsis,)
+        return row_shape[:-1] + (len(range(*dates.indices(shape[-1]))),), (Ellipsis, dates)
+
+    @staticmethod
+    def runs(rows):
+        """ Split sorted, unique rows into runs of adjacent rows. Returns the first row and length of each run """
+        breaks = np.where(np.diff(rows) != 1)[0] + 1
+        run_starts = rows[np.concatenate(([0], breaks)).astype(int)] if rows.size else rows
+        run_lengths = np.diff(np.concatenate(([0], breaks, [rows.size])))
+        return run_starts, run_lengths
+
+    def scan(self, rows, chunk=2500, window=None):
+        """ Stream the given rows, in ascending order, in chunks. Yields the position of each chunk within rows and
+        the rows in the chunk. The next chunk is read ahead while the current one is used, and pages behind the scan
+        are released once they fall more than 'window' MB behind it, so that the resident size of the mapping stays
+        bounded however many rows are scanned """
+        from .parameters import matrix_storage
+
+        window = (window or matrix_storage.scan_window) * 1024. ** 2
+        window_rows = max(1, int(window // (int(np.prod(self.shape[1:])) * np.dtype(self.dtype).itemsize)))
+        released = int(rows[0]) if len(rows) else 0  # Rows before this have been released
+        for position in range(0, len(rows), chunk):
+            block = rows[position:position + chunk]
+            upcoming = rows[position + chunk:position + 2 * chunk]
+            if len(upcoming):
+                self.advise(*self.runs(np.asarray(upcoming)))
+            yield slice(position, position + len(block)), block
+            keep_from = int(block[-1]) + 1 - window_rows
+            if keep_from > released:
+                self.release(released, keep_from)
+                released = keep_from
+
+    def release(self, start, end):
+        """ Drop the pages holding rows start:end from this process's file mapping. Changes have already been made
+        to the shared file pages, and any row is paged back in if it is read again. Matrices held in memory have no
+        file mapping and are not affected """
+        row_size = int(np.prod(self.shape[1:])) * np.dtype(self.dtype).itemsize
+        base = self.offset % mmap.ALLOCATIONGRANULARITY
+        first = -(-(base + int(start) * row_size) // mmap.PAGESIZE) * mmap.PAGESIZE  # Only whole pages are dropped
+        last = (base + int(end) * row_size) // mmap.PAGESIZE * mmap.PAGESIZE
+        if last > first:
+            self.madvise(getattr(mmap, 'MADV_DONTNEED', None), first, last - first)
+
+    def advise(self, run_starts, run_lengths):
+        """ Tell the kernel which ranges of the file are about to be read, so they can be paged in ahead of time """
+        row_size = int(np.prod(self.shape[1:])) * np.dtype(self.dtype).itemsize
+        base = self.offset % mmap.ALLOCATIONGRANULARITY  # Position of the data within the mapping
+        for start, length in zip(run_starts, run_lengths):
+            offset = (base + int(start) * row_size) // mmap.PAGESIZE * mmap.PAGESIZE
+            self.madvise(getattr(mmap, 'MADV_WILLNEED', None), offset, base + int(start + length) * row_size - offset)
+
+    def madvise(self, advice, start, length):
+        """ Give the kernel advice about a range of bytes of the file mapping. This is skipped if the matrix has no
+        file mapping, or if the platform or the NumPy memmap does not support it """
+        mapping = getattr(self.mapping, '_mmap', None)  # The mmap object behind a NumPy memmap is not public
+        if advice is None or not hasattr(mapping, 'madvise'):
+            return
+        try:
+            mapping.madvise(advice, start, length)
+        except (OSError, ValueError):
+            pass
+
     def update(self, key, value, aliased=True):
-        array = self.writer
         array_index = self.lookup.get(key) if aliased else key
         if array_index is not None:
-            array[array_index] = value
+            self.writer[array_index] = value
         else:
-            print("Index {} not found in {} array".format(key, self.name))
-        del array
+            print("Index {} not found in {} array".format(key, self.path))
 
     @property
     def reader(self):
-        return np.memmap(self.path, dtype=self.dtype, mode='r+', shape=self.shape)
+        return self.open()
 
     @property
     def copy(self):
-        return np.memmap(self.path, dtype=self.dtype, mode='c', shape=self.shape)
+        self.flush()
+        if self.backend != 'file':
+            return np.array(self.mapping)
+        return np.memmap(self.path, dtype=self.dtype, mode='c', shape=self.shape, offset=self.offset)
 
     @property
     def writer(self):
-        mode = 'r+' if os.path.isfile(self.path) else 'w+'
-        return np.memmap(self.path, dtype=self.dtype, mode=mode, shape=self.shape)
+        return self.open()
+
+
+class RowBuffer(object):
+    """ Stages rows bound for a MemoryMatrix and writes them together, sorted by row, when the buffer fills or is
+    flushed. Rows are given by label, as in MemoryMatrix.update. The matrix flushes the buffer before it is read, so
+    staged rows are never missed by fetch or fetch_multiple """
+
+    def __init__(self, matrix, size=None):
+        from .parameters import matrix_storage
+
+        self.matrix = matrix
+        row_size = int(np.prod(matrix.shape[1:])) * np.dtype(matrix.dtype).itemsize
+        self.size = int(size or max(1, matrix_storage.write_buffer * 1024. ** 2 // row_size))
+        self.rows = np.empty((self.size,) + matrix.shape[1:], dtype=matrix.dtype)
+        self.index = np.empty(self.size, dtype=np.int64)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def update(self, key, value, aliased=True):
+        array_index = self.matrix.lookup.get(key) if aliased else key
+        if array_index is None:
+            print("Index {} not found in {} array".format(key, self.matrix.path))
+            return
+        if self.count == self.size:
+            self.flush()
+        self.rows[self.count] = value
+        self.index[self.count] = array_index
+        self.count += 1
+
+    def flush(self):
+        """ Write staged rows to the matrix in row order. If a row was staged more than once, the last value is kept """
+        count, self.count = self.count, 0
+        if count:
+            rows, last = np.unique(self.index[count - 1::-1], return_index=True)
+            self.matrix.writer[rows] = self.rows[count - 1 - last]
+
+
+def prefetch(load, items, background=True):
+    """ Yield each item with the result of load(item). While an item is being used, the next one is loaded on a
+    background thread, so that reads overlap with computation. Loading is sequential if matrix_storage.prefetch is
+    off, or if background is False """
+    from .parameters import matrix_storage
+
+    if not (background and matrix_storage.prefetch):
+        for item in items:
+            yield item, load(item)
+        return
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        pending = None
+        for item in items:
+            future = loader.submit(load, item)
+            if pending is not None:
+                yield pending[0], pending[1].result()
+            pending = item, future
+        if pending is not None:
+            yield pending[0], pending[1].result()
+
+
+def start_scenario_worker(n_threads, scratch):
+    """ Set up a scenario worker process, which keeps its scratch matrices in the workspace of the main process """
+    numba.set_num_threads(n_threads)
+    attach_workspace(scratch)
+
+
+_recipes = None  # Recipes of the region being processed, in a recipe worker process
+
+
+def start_recipe_worker(recipes, n_threads, scratch):
+    """ Set up a recipe worker process with its own copy of the recipes for the region """
+    global _recipes
+    numba.set_num_threads(n_threads)
+    attach_workspace(scratch)
+    _recipes = recipes
+
+
+def process_recipe_block(reaches):
+    """ Process a block of reaches in a recipe worker, and write out the output rows staged by the worker """
+    _recipes.process_recipes(reaches)
+    for matrix in (_recipes.o.time_series, _recipes.o.exceedances):
+        if matrix is not None:
+            matrix.flush()
+
+
+def release_memory(size, shared=None):
+    """ Release the memory held by a scratch matrix """
+    MemoryMatrix.memory_used -= size
+    if shared is not None:
+        try:
+            shared.close()
+        except BufferError:  # Arrays still refer to the block, which is freed once they are gone
+            pass
+        shared.unlink()
+
+
+class CompressedMatrix(MemoryMatrix):
+    """ A read-only MemoryMatrix which stores blocks of rows compressed on disk. The offset and size of each block are
+    kept in an index file alongside the data. Blocks are decompressed as they are read and held in a bounded
+    least-recently-used cache """
+
+    codecs = {'zlib': (zlib.compress, zlib.decompress), 'lzma': (lzma.compress, lzma.decompress)}
+
+    def __init__(self, dimensions, dtype=np.float32, path=None, cache_size=512.):
+        self.index_path = path + ".index.npz"
+        index = np.load(self.index_path)
+        self.offsets, self.sizes = index['offsets'], index['sizes']
+        self.block_rows, self.codec = int(index['block_rows']), str(index['codec'])
+        self.cache_size = cache_size * 1024. ** 2  # MB -> bytes
+        self.cache, self.cached_bytes, self.file = OrderedDict(), 0, None
+        super(CompressedMatrix, self).__init__(dimensions, dtype, path, existing=True)
+        if tuple(index['shape']) != self.shape:
+            raise ValueError("Compressed matrix {} has shape {}, expected {}".format(path, index['shape'], self.shape))
+
+    @classmethod
+    def create(cls, source, path, block_rows=64, codec='zlib', cache_size=512.):
+        """ Compress the contents of a MemoryMatrix into a new CompressedMatrix at path """
+        compress = cls.codecs[codec][0]
+        offsets, sizes = [], []
+        with open(path, 'wb') as f:
+            for start in range(0, source.shape[0], block_rows):
+                rows = np.arange(start, min(start + block_rows, source.shape[0]))
+                block = compress(np.ascontiguousarray(source.fetch_multiple(rows, aliased=False)).tobytes())
+                offsets.append(f.tell())
+                sizes.append(len(block))
+                f.write(block)
+        np.savez(path + ".index.npz", offsets=np.int64(offsets), sizes=np.int64(sizes), block_rows=block_rows,
+                 codec=codec, shape=np.int64(source.shape))
+        return cls(source.dimensions, source.dtype, path, cache_size)
+
+    def __getstate__(self):
+        state = super(CompressedMatrix, self).__getstate__()
+        state.update(cache=OrderedDict(), cached_bytes=0, file=None)
+        return state
+
+    def open(self):
+        raise TypeError("Compressed matrix {} can only be read with fetch or fetch_multiple".format(self.path))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.cache, self.cached_bytes, self.file = OrderedDict(), 0, None
+
+    def block(self, number):
+        """ Return a decompressed block of rows, from the cache if possible """
+        block = self.cache.get(number)
+        if block is not None:
+            self.cache.move_to_end(number)
+            return block
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        self.file.seek(self.offsets[number])
+        data = self.codecs[self.codec][1](self.file.read(self.sizes[number]))
+        block = np.frombuffer(data, dtype=self.dtype).reshape((-1,) + self.shape[1:])
+        self.cache[number] = block
+        self.cached_bytes += block.nbytes
+        while self.cached_bytes > self.cache_size and len(self.cache) > 1:
+            self.cached_bytes -= self.cache.popitem(last=False)[1].nbytes
+        return block
+
+    def fetch(self, index, aliased=False, copy=False, verbose=True):
+        row = index if aliased else self.lookup.get(index)
+        if row is None or not 0 <= row < self.shape[0]:
+            if verbose:
+                print("{} not found".format(index))
+            return None
+        return self.read_rows(np.int64([row]))[0]
+
+    def read_rows(self, indices, columns=None, dates=None):
+        """ Read rows block by block in file order and return them in the order requested """
+        rows, order = np.unique(indices, return_inverse=True)
+        shape, window = self.selection(self.shape, columns, dates)
+        out_array = np.empty((rows.size,) + shape, dtype=self.dtype)
+        blocks = rows // self.block_rows
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(blocks)) + 1, [rows.size])).astype(int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            block = self.block(blocks[start])[(rows[start:end] - blocks[start] * self.block_rows,) + window]
+            out_array[start:end] = block if columns is None else block[:, columns]
+        return out_array[order.ravel()]
+
+    def update(self, key, value, aliased=True):
+        raise TypeError("Compressed matrix {} is read-only".format(self.path))
 
 
 class Geometry(object):
@@ -126,16 +698,24 @@ class Geometry(object):
         self.region = region
         self.flowline_path = os.path.join(geometry_dir, "region_{}_flowlines".format(self.region))
         self.intake_path = os.path.join(geometry_dir, "region_{}_intakes".format(self.region))
+        self.container_path = self.flowline_path + ".mtx"
         self.key_path = self.flowline_path + "_key.npz"
+        self.data_path, self.offset = self.flowline_path + ".dat", 0
 
         self._intakes = None
         self._map = None
         self._shape = None
 
     def load_key(self):
-        data = np.load(self.key_path)
-        data_map = {comid: (start_row, end_row) for comid, start_row, end_row in data['map']}
-        shape = tuple(data['shape'])
+        """ Read the row range of each reach from the flowline container, or from the key file of the older format """
+        if os.path.exists(self.container_path):
+            container = MatrixContainer(self.container_path)
+            self.data_path, self.offset = self.container_path, container.offset
+            table, shape = container.table('map'), container.shape
+        else:
+            data = np.load(self.key_path)
+            table, shape = data['map'], tuple(data['shape'])
+        data_map = {comid: (start_row, end_row) for comid, start_row, end_row in table}
         return data_map, shape
 
     def fetch(self, comid, feature_type, verbose=False):
@@ -144,7 +724,7 @@ class Geometry(object):
             if address is None and verbose:
                 print("Reach {} not found in geometry file for Region {}".format(comid, self.region))
             elif address is not None:
-                array = np.memmap(self.flowline_path + ".dat", dtype=np.float32, shape=self.shape, mode='r+')
+                array = np.memmap(self.data_path, dtype=np.float32, shape=self.shape, mode='r+', offset=self.offset)
                 start_row, end_row = address
                 coordinates = array[start_row:end_row].tolist()
                 del array
@@ -255,6 +835,28 @@ class Hydroregion(object):
         remaining_reaches = self.active_reaches - self.run_reaches
         yield remaining_reaches, None
 
+    def routing(self, reaches):
+        """ Order a batch of reaches for downstream accumulation. Returns the reaches, ordered so that each comes after
+        every reach upstream of it, and for each reach the nearest active reach downstream of it in the batch, with
+        the travel time between them in days. Inactive reaches contribute no load and are passed through """
+        downstream, depth, times = self.nav.drainage()
+        active = np.zeros(downstream.size, dtype=bool)
+        active[[self.nav.reach_to_alias[r] for r in self.active_reaches if r in self.nav.reach_to_alias]] = True
+        aliases = np.array([self.nav.reach_to_alias[r] for r in reaches if r in self.nav.reach_to_alias],
+                           dtype=np.int64)
+        in_batch = np.zeros(downstream.size, dtype=bool)
+        in_batch[aliases] = True
+        aliases = aliases[np.argsort(-depth[aliases], kind='stable')]
+        receivers = {}
+        for alias in aliases:
+            receiver = downstream[alias]
+            while receiver >= 0 and not active[receiver]:
+                receiver = downstream[receiver]
+            if receiver >= 0 and in_batch[receiver]:
+                receivers[int(self.nav.alias_to_reach[alias])] = \
+                    (int(self.nav.alias_to_reach[receiver]), int(np.int32(times[alias] - times[receiver])))
+        return [int(self.nav.alias_to_reach[alias]) for alias in aliases], receivers
+
     def confine(self):
 
         # Recipe/reaches that are (1) in the upstream file and (2) have a recipe file in at least 1 yr
@@ -274,23 +876,38 @@ class Hydroregion(object):
 
 
 class ImpulseResponseMatrix(MemoryMatrix):
-    """ A matrix designed to hold the results of an impulse response function for 50 day offsets """
+    """ A matrix designed to hold the results of an impulse response function for 50 day offsets. The transforms used
+    for FFT convolution are cached as they are requested """
 
     def __init__(self, n_dates, size=50):
         self.n_dates = n_dates
         self.size = size
+        self.fft_length = fft_length(2 * n_dates - 1)  # Long enough that a circular convolution doesn't wrap around
+        self.transforms = {}
         super(ImpulseResponseMatrix, self).__init__([size, n_dates])
-        for i in range(size):
-            irf = impulse_response_function(i, 1, self.n_dates)
-            self.update(i, irf)
+        with self.buffered(size) as buffer:
+            for i in range(size):
+                buffer.update(i, self.response(i), aliased=False)
+
+    def response(self, index):
+        if index == 0:  # No travel time, mass arrives the same day
+            return np.eye(1, self.n_dates)[0]
+        return impulse_response_function(index, 1, self.n_dates)
 
     def fetch(self, index):
-        if index <= self.size:
-            irf = super(ImpulseResponseMatrix, self).fetch(index, verbose=False)
+        if index < self.size:
+            irf = super(ImpulseResponseMatrix, self).fetch(index, aliased=True, verbose=False)
         else:
-            irf = impulse_response_function(index, 1, self.n_dates)
+            irf = self.response(index)
         return irf
 
+    def transform(self, index):
+        """ Real FFT of the impulse response for an offset, padded to the convolution length """
+        transform = self.transforms.get(index)
+        if transform is None:
+            transform = self.transforms[index] = np.fft.rfft(self.fetch(index), self.fft_length)
+        return transform
+
 
 class InputParams(object):
     """
@@ -300,11 +917,19 @@ class InputParams(object):
     """
 
     def __init__(self, input_dict):
-        from .parameters import time_of_travel
+        from .parameters import time_of_travel, sweep, precision
 
         # Read input dictionary
         self.__dict__.update(input_dict)
 
+        # Floating point precision of the run
+        self.float_type = np.dtype(getattr(self, 'float_type', precision.float_type))
+
+        # Parameter sweep: parameters given as arrays are sampled together, one sample per element
+        self.sweep = {param: np.float64(getattr(self, param)) for param in sweep.parameters
+                      if np.ndim(getattr(self, param, None)) > 0}
+        self.n_samples = np.broadcast(*self.sweep.values()).size if self.sweep else 1
+
         # JCH - enables running just the Mark Twain
         if self.region == "Mark Twain Demo":
             self.region = 'mtb'
@@ -345,12 +970,34 @@ class InputParams(object):
         self.write_time_series = False
         self.read_overlay = False
 
+    def samples(self):
+        """ Expand a parameter sweep into a set of inputs with one value for each swept parameter. Soil half-life
+        sets the aqueous degradation rate, and apprate_factor multiplies the rate of every application """
+        if not self.sweep:
+            return [self]
+        samples = []
+        sweep = dict(zip(self.sweep.keys(), np.broadcast_arrays(*self.sweep.values())))
+        for n in range(self.n_samples):
+            sample = copy.copy(self)
+            if 'koc' in sweep:
+                sample.koc = sweep['koc'][n]
+            if 'soil_hl' in sweep:
+                sample.soil_hl = sweep['soil_hl'][n]
+                sample.deg_aqueous = math.log(2) / sample.soil_hl
+            if 'apprate_factor' in sweep:
+                sample.apprate_factor = sweep['apprate_factor'][n]
+                sample.applications = self.applications.copy()
+                sample.applications[:, 10] *= sample.apprate_factor
+            samples.append(sample)
+        return samples
+
 
 class Navigator(object):
     def __init__(self, region_id, upstream_path):
         self.file = os.path.join(upstream_path, "region_{}.npz".format(region_id))
         self.paths, self.times, self.map, self.alias_to_reach, self.reach_to_alias = self.load()
         self.reach_ids = set(self.reach_to_alias.keys())
+        self._drainage = None
 
     def load(self):
         assert os.path.isfile(self.file), "Upstream file {} not found".format(self.file)
@@ -359,6 +1006,30 @@ class Navigator(object):
         reverse_conversion = dict(zip(conversion_array, np.arange(conversion_array.size)))
         return data['paths'], data['time'], data['path_map'], conversion_array, reverse_conversion
 
+    def drainage(self):
+        """ For each reach alias, return the alias of the reach immediately downstream (-1 at an outlet), the number of
+        reaches between the reach and its outlet, and the travel time from the reach to its outlet. Each path begins
+        one column upstream of a reach in the most recent path that starts at a lower column """
+        if self._drainage is None:
+            downstream = np.full(self.alias_to_reach.size, -1, dtype=np.int64)
+            depth = np.zeros(self.alias_to_reach.size, dtype=np.int64)
+            times = np.zeros(self.alias_to_reach.size)
+            stack = []  # First column and reaches of the paths leading to the current path
+            for path, path_times in zip(self.paths, self.times):
+                path = np.asarray(path, dtype=np.int64)
+                start = int(self.map[path[0]][2])
+                while stack and stack[-1][0] >= start:
+                    stack.pop()
+                if stack:
+                    parent_start, parent = stack[-1]
+                    downstream[path[0]] = parent[start - 1 - parent_start]
+                downstream[path[1:]] = path[:-1]
+                depth[path] = start + np.arange(path.size)
+                times[path] = path_times
+                stack.append((start, path))
+            self._drainage = downstream, depth, times
+        return self._drainage
+
     def upstream_watershed(self, reach_id, mode='reach', return_times=True):
 
         def unpack(array):
@@ -392,14 +1063,22 @@ class Navigator(object):
 class RecipeMap(MemoryMatrix):
     def __init__(self, region_id, recipe_path):
         self.region = region_id
-        self.path = os.path.join(recipe_path, "region_{}".format(self.region))
-        self.key_path = self.path + "_key.npz"
+        self.path = os.path.join(recipe_path, "region_{}.mtx".format(self.region))
+        self.key_path = os.path.join(recipe_path, "region_{}_key.npz".format(self.region))
+        self.dtype = np.int32
 
         self.map, self.shape, self.scenarios = self.load_key()
 
     def load_key(self):
-        data = np.load(self.key_path)
-        scenario_index, comid_table, shape = data['scenarios'], data['map'], data['shape']
+        """ Read the recipe map container, or the key file of a recipe map in the older format """
+        if os.path.exists(self.path):
+            container = MatrixContainer(self.path)
+            self.offset = container.offset
+            scenario_index, comid_table, shape = container.table('scenarios'), container.table('map'), container.shape
+        else:
+            self.path = os.path.join(os.path.dirname(self.path), "region_{}.dat".format(self.region))
+            data = np.load(self.key_path)
+            scenario_index, comid_table, shape = data['scenarios'], data['map'], data['shape']
         comid_map = {(comid, year): (start_row, end_row) for year, comid, start_row, end_row in comid_table}
 
         return comid_map, tuple(shape), scenario_index
@@ -409,29 +1088,52 @@ class RecipeMap(MemoryMatrix):
         if address is None and verbose:
             print("Reach {} not found in recipe map for Region {}".format(comid, self.region))
         elif address is not None:
-            array = np.memmap(self.path + ".dat", np.int32, shape=self.shape)
             start_row, end_row = address
-            areas, aliases = array[start_row:end_row].T
-            scenario_ids = self.scenarios[aliases]
-            del array
-            return scenario_ids, areas
+            areas, aliases = self.reader[start_row:end_row].T
+            return (aliases if aliased else self.scenarios[aliases]), areas
+
+    def fetch_year(self, comids, year):
+        """ Fetch the recipes of many reaches for a year in compressed sparse row form. Returns the position in the
+        scenario aliases and areas where the recipe of each reach starts and ends, and the aliases and areas """
+        bounds = np.int64([self.map.get((comid, year), (0, 0)) for comid in comids]).reshape(-1, 2)
+        lengths = bounds[:, 1] - bounds[:, 0]
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        rows = np.repeat(bounds[:, 0] - indptr[:-1], lengths) + np.arange(indptr[-1])
+        areas, aliases = self.reader[rows].T
+        return indptr, aliases, areas
 
 
 class Recipes(object):
     def __init__(self, i, o, year, region, scenarios, output_path, active_reaches):
-        self.i = i
+        self.chemicals = i if isinstance(i, list) else [i]
+        self.i = self.chemicals[0]
         self.o = o
         self.year = year
         self.region = region
-        self.output_dir = os.path.join(output_path, i.token)
+        self.output_dir = os.path.join(output_path, self.i.token)
         self.scenario_matrix = scenarios.processed_matrix
+        self.crops = scenarios.catalog['crop']
         self.recipe_ids = sorted(region.active_reaches)
         self.outlets = set(self.recipe_ids) & set(self.region.lake_table.outlet_comid)
         self.active_reaches = active_reaches
-        self.processed = set()
 
-        # Initialize local matrix: matrix of local runoff and mass, for rapid internal recall
-        self.local = MemoryMatrix([self.recipe_ids, 2, self.i.n_dates])
+        # Routing of reaches, set when the region is scheduled
+        self.batch = {}  # Number of the cascade batch of each reach
+        self.senders = {}  # Reaches upstream which pass their total load to each reach, with the travel time from them
+        self.totals = None  # Total load of each reach that passes it on, (mass.../runoff, dates)
+
+        # Initialize local matrix: matrix of local mass for each chemical and runoff, for rapid internal recall
+        self.local = MemoryMatrix([self.recipe_ids, len(self.chemicals) + 1, self.i.n_dates])
+        self.local.buffered()
+
+        # Eroded soil and mass for each chemical, for benthic partitioning
+        self.erosion = MemoryMatrix([self.recipe_ids, len(self.chemicals) + 1, self.i.n_dates])
+
+        # Row in the scenario matrix of each scenario in the recipe map. -1 indicates a scenario that is not present
+        self.scenario_rows = self.scenario_matrix.lookup.rows(self.region.recipe_map.scenarios)
+
+        # Sum the scenarios of every recipe into local loads for the year
+        self.recipes = self.build_local()
 
     def burn_reservoir(self, lake, upstream_reaches):
 
@@ -440,56 +1142,92 @@ class Recipes(object):
         if lake is not None and upstream_reaches:
 
             # Get the convolution function
-            irf = impulse_response_function(1, lake.residence_time, self.i.n_dates)
+            irf = impulse_response_function(1, lake.residence_time, self.i.n_dates).astype(self.i.float_type)
 
             # Pull mass and runoff time series for all upstream reaches and add together
             if upstream_reaches:
 
                 upstream_reaches = np.array(list(upstream_reaches))
 
-                old_mass, old_runoff = self.local.fetch_multiple(upstream_reaches).sum(axis=0)
+                old_local = self.local.fetch_multiple(upstream_reaches).sum(axis=0)
+                old_mass, old_runoff = old_local[:-1], old_local[-1]
 
                 # Modify combined time series to reflect reservoir
-                new_mass = np.convolve(old_mass, irf)[:self.i.n_dates]
+                new_mass = np.array([np.convolve(mass, irf)[:self.i.n_dates] for mass in old_mass])
                 if time_of_travel_params.convolve_runoff:  # Convolve runoff
                     new_runoff = np.convolve(old_runoff, irf)[:self.i.n_dates]
                 else:  # Flatten runoff
                     new_runoff = np.repeat(np.mean(old_runoff), self.i.n_dates)
 
-                # Add all lake mass and runoff to outlet
-                self.local.update(lake.outlet_comid, np.array([new_mass, new_runoff]))
-
-    def fetch_scenarios(self, recipe_id):
-        """  Fetch all scenarios and multiply by area.  For erosion, area is adjusted. """
-        try:
-            scenarios, areas = self.region.recipe_map.fetch(recipe_id, self.year, aliased=True).T
-        except AttributeError:
-            return None, None
-        else:
-            # Pull data from memmap. Config is (scenarios, vars, dates)
-            data = self.scenario_matrix.fetch_multiple(scenarios, copy=True, aliased=False)
-
-            # Adjust axes so that configuration is (var, date, scenario)
-            data = np.rollaxis(data, 0, 3)
-
-            # Modify values based on area of scenario
-            data[:2] *= areas  # runoff, runoff_mass.
-            data[2:] *= np.power(areas / 10000., .12)  # erosion, erosion_mass
-
-            return scenarios, data
-
-    def local_loading(self, recipe_id, cumulative, process_benthic=False):
-        """ Pull all scenarios in recipe from scenario matrix and adjust for area """
-
-        # Sum time series from all scenarios
-        runoff, erosion, runoff_mass, erosion_mass = cumulative
+                # Add all lake mass and runoff to the local load of the outlet
+                outlet_local = self.local.fetch(lake.outlet_comid, verbose=False)
+                if outlet_local is not None:
+                    self.local.buffer.update(lake.outlet_comid, np.vstack([new_mass, new_runoff]) + outlet_local)
+
+    def build_local(self):
+        """ Sum the scenarios of every recipe, weighted by area, into the local matrix. The recipes make up a sparse
+        matrix of reaches by scenarios, which is multiplied by the processed scenarios one block of scenarios at a time,
+        so that each scenario is read once. For erosion, area is adjusted. Returns the reaches that have a recipe for
+        the year """
+        from .parameters import matrix_storage
+
+        # Weight of each scenario in each recipe, for runoff and erosion. Scenarios that are not present are dropped
+        indptr, aliases, areas = self.region.recipe_map.fetch_year(self.recipe_ids, self.year)
+        scenarios = self.scenario_rows[aliases]
+        found = scenarios >= 0
+        reach_index = np.repeat(np.arange(len(self.recipe_ids)), np.diff(indptr))[found]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(reach_index, minlength=len(self.recipe_ids)))))
+        areas = areas[found].astype(np.float64)
+        weights = np.stack([areas, np.power(areas / 10000., .12)], axis=1)  # runoff, erosion
+        rows, columns = np.unique(scenarios[found], return_inverse=True)
+        columns = columns.ravel()
+
+        # The same weights, ordered by scenario, so that a block of scenarios adds to the reaches that include them
+        by_scenario = np.argsort(columns, kind='stable')
+        scenario_ptr = np.concatenate(([0], np.cumsum(np.bincount(columns, minlength=rows.size))))
+
+        # Scenarios processed on demand are all needed, and are processed before they are read
+        treated = self.scenario_matrix.mass_index[rows]
+        if self.scenario_matrix.processor is not None:
+            self.scenario_matrix.process(treated[treated >= 0])
+
+        # Blocks of scenarios are sized to the budget. The next block is read while the current one is added
+        n_values = self.scenario_matrix.shape[2]
+        block = max(1, int(matrix_storage.local_block * 1024. ** 2 //
+                           (2 * n_values * self.i.n_dates * np.dtype(np.float32).itemsize)))
+        blocks = [slice(start, min(start + block, rows.size)) for start in range(0, rows.size, block)]
+        read = lambda scenarios: self.scenario_matrix.fetch_multiple(rows[scenarios], aliased=False)
+        scenario_totals = np.zeros((rows.size, 2, n_values))  # Sum over dates, for contributions by crop
+        local, erosion = np.asarray(self.local.writer), np.asarray(self.erosion.writer)
+        for scenarios, data in prefetch(read, blocks):
+
+            # Config is (scenarios, [runoff, erosion], [water/soil, mass...], dates)
+            scenario_totals[scenarios] = data.sum(axis=3)
+            entries = by_scenario[scenario_ptr[scenarios.start]:scenario_ptr[scenarios.stop]]
+            add_scenarios(columns[entries] - scenarios.start, reach_index[entries], weights[entries], data, local,
+                          erosion)
+
+        # Assess the contributions to each recipe from each source (runoff/erosion) and crop
+        crops = self.crops[rows]
+        recipes = set()
+        for n, recipe_id in enumerate(self.recipe_ids):
+            if (recipe_id, self.year) in self.region.recipe_map.map:
+                recipes.add(recipe_id)
+                recipe = slice(indptr[n], indptr[n + 1])
+                loads = scenario_totals[columns[recipe], :, 1:] * weights[recipe, :, None]  # (scenario, source, chem)
+                self.o.update_contributions(recipe_id, crops[columns[recipe]], loads.transpose(1, 2, 0))
+        return recipes
+
+    def local_loading(self, recipe_id, process_benthic=False):
+        """ Fetch the local mass and runoff of a reach. Lake outlets include the load passed through the reservoir """
+        local = self.local.fetch(recipe_id, copy=True)
+        runoff_mass, runoff = local[:-1], local[-1]
 
         # Run benthic/water column partitioning
-        benthic_conc = self.partition_benthic(recipe_id, erosion, erosion_mass) if process_benthic else None
-
-        # If it's a lake outlet, do this
-        if recipe_id in self.outlets:
-            runoff_mass, runoff = np.array([runoff_mass, runoff]) + self.local.fetch(recipe_id)
+        benthic_conc = None
+        if process_benthic:
+            eroded = self.erosion.fetch(recipe_id)
+            benthic_conc = self.partition_benthic(recipe_id, eroded[0], eroded[1:])
 
         return runoff_mass, runoff, benthic_conc
 
@@ -501,97 +1239,485 @@ class Recipes(object):
         surface_area = self.region.flow_file.loc[recipe_id]["surface_area"]
         soil_volume = benthic.depth * surface_area
         pore_water_volume = soil_volume * benthic.porosity
-        benthic_mass = benthic_loop(erosion, erosion_mass, soil_volume)
+        benthic_mass = np.array([benthic_loop(erosion, mass, soil_volume) for mass in erosion_mass])
         return benthic_mass / pore_water_volume
 
-    def process_recipes(self, recipe_ids, progress_interval=1000):
+    def __getstate__(self):
+        # Workers only route loads that have already been summed, and don't need the scenarios
+        state = self.__dict__.copy()
+        state.update(scenario_matrix=None, crops=None)
+        return state
+
+    def schedule(self):
+        """ Burn reservoirs and group the reaches of the region into levels which can each be processed in parallel.
+        Reservoirs only depend on local loads, so they are all burned first, in downstream order. Loads are then
+        accumulated within each cascade batch: a reach is placed one level below the highest reach that passes its load
+        to it. With gamma convolution, reaches gather their own upstream watersheds, and all are independent.
+        Returns the levels, in the order that they are to be processed """
+        from .parameters import time_of_travel
+
+        accumulate = not time_of_travel.gamma_convolve
+        if accumulate:
+            self.totals = MemoryMatrix([self.recipe_ids, len(self.chemicals) + 1, self.i.n_dates],
+                                       dtype=self.i.float_type)
+        level = {}
+        for number, (reaches, lake) in enumerate(self.region.cascade()):
+            reaches, receivers = self.region.routing(reaches)
+            for reach in reaches:  # Upstream first, so each reach has its level before its receiver is reached
+                self.batch[reach] = number
+                level.setdefault(reach, 0)
+                receiver = receivers.get(reach)
+                if accumulate and receiver is not None and receiver[1] < self.i.n_dates:
+                    downstream, travel_time = receiver
+                    self.senders.setdefault(downstream, []).append((reach, travel_time))
+                    level[downstream] = max(level.get(downstream, 0), level[reach] + 1)
+
+            # Modify all stored recipe data in the batch to simulate passage through reservoir
+            self.burn_reservoir(lake, reaches)
+        self.local.flush()
+
+        levels = [[] for _ in range(max(level.values(), default=-1) + 1)]
+        for reach, number in level.items():
+            levels[number].append(reach)
+        return levels
+
+    def process_region(self, n_workers=None, progress_interval=1000):
+        """ Process every recipe in the region, a level at a time. With more than one worker, each level is divided
+        among a pool of worker processes, which read and write the same matrices """
+        from .parameters import recipe_processing
+
+        levels = self.schedule()
+        if n_workers is None:
+            n_workers = recipe_processing.n_workers
+        matrices = [self.local, self.erosion, self.totals, self.o.time_series, self.o.exceedances, self.o.contributions]
+        if n_workers > 1 and any(m is not None and m.backend == 'ram' for m in matrices):
+            print("Recipe matrices are held in process memory, which workers cannot share. Using 1 worker")
+            n_workers = 1
+
+        # Workers are spawned rather than forked, since the numba thread pool is not fork-safe. The recipes are passed
+        # to each worker once, when it starts. Staged output rows are written before workers write their own
+        pool = None
+        if n_workers > 1:
+            for matrix in matrices:
+                if matrix is not None:
+                    matrix.flush()
+            n_threads = max(1, numba.get_num_threads() // n_workers)
+            pool = get_context("spawn").Pool(n_workers, initializer=start_recipe_worker,
+                                                 initargs=(self, n_threads, workspace()))
+        try:
+            processed = 0
+            for level in levels:
+                if pool is not None and len(level) > 1:
+                    blocks = np.array_split(np.array(level), min(len(level), n_workers * 4))
+                    pool.map(process_recipe_block, [list(map(int, block)) for block in blocks])
+                else:
+                    self.process_recipes(level)
+                if (processed + len(level)) // progress_interval > processed // progress_interval:
+                    print("Processed {} of {} recipes".format(processed + len(level), len(self.recipe_ids)))
+                processed += len(level)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        for matrix in matrices:
+            if matrix is not None:
+                matrix.flush()
+
+    def process_recipes(self, recipe_ids):
+        """ Process a set of reaches which don't depend on each other. Reaches that pass on their load must have been
+        processed before the reaches that receive it """
+
+        # Unless travel time is modeled with gamma convolution, loads are accumulated downstream: the total load of
+        # each reach is its local load plus the total loads passed to it from upstream, shifted by the travel time.
+        # Otherwise, the upstream watershed of each reach is gathered in turn. The mode is set when the region is
+        # scheduled, since parameters changed in the main process are not seen by workers
+        accumulate = self.totals is not None
 
         for recipe_id in recipe_ids:
 
             # Determine whether to do additional analysis on recipe
             active_recipe = recipe_id in self.active_reaches
 
-            self.processed.add(recipe_id)
-            if not len(self.processed) % progress_interval:
-                print("Processed {} of {} recipes".format(len(self.processed), len(self.recipe_ids)))
-
-            # Fetch time series data from all scenarios in recipe
-            scenarios, time_series = self.fetch_scenarios(recipe_id)  # (var, date, scenario)
-
-            if scenarios is not None:
-
-                # Assess the contributions to the recipe from each source (runoff/erosion) and crop
-                self.o.update_contributions(recipe_id, scenarios, time_series[[1, 3]].sum(axis=1))
-
-                # Process local contributions
-                local_mass, local_runoff, benthic_conc = \
-                    self.local_loading(recipe_id, time_series.sum(axis=2), active_recipe)
-
-                # Update local array with mass and runoff
-                self.local.update(recipe_id, np.array([local_mass, local_runoff]))
-
-                # Upstream processing and output generation only done if the recipe is in the write list
-                if active_recipe:
-
-                    # Process upstream contributions
-                    total_flow, total_runoff, total_mass, total_conc = self.upstream_loading(recipe_id)
-
-                    if total_conc is not None:
-                        # Calculate exceedances
-                        self.o.update_exceedances(recipe_id, total_conc)
-
-                        # Store results in output array
-                        self.o.update_time_series(recipe_id, total_flow, total_runoff, total_mass, total_conc,
-                                                  benthic_conc)
+            # Local mass and runoff, summed from all scenarios in the recipe
+            local = None
+            has_recipe = recipe_id in self.recipes
+            if has_recipe:
+                local_mass, local_runoff, benthic_conc = self.local_loading(recipe_id, active_recipe)
+                local = np.vstack([local_mass, local_runoff])
+
+            # Reaches without scenarios still pass upstream load downstream
+            if accumulate:
+                total = self.accumulate(recipe_id, local)
+
+            # Upstream processing and output generation only done if the recipe is in the write list
+            if has_recipe and active_recipe:
+
+                # Process upstream contributions
+                mass, runoff = (total[:-1], total[-1]) if accumulate else self.upstream_loading(recipe_id)
+                total_flow, total_runoff, total_mass, total_conc = self.reach_concentration(recipe_id, mass, runoff)
+
+                if total_conc is not None:
+                    # Calculate exceedances
+                    self.o.update_exceedances(recipe_id, total_conc)
+
+                    # Store results in output array
+                    self.o.update_time_series(recipe_id, total_flow, total_runoff, total_mass, total_conc,
+                                              benthic_conc)
+
+    def accumulate(self, reach, local):
+        """ Add the total loads passed to a reach from upstream to its local load, each offset by the travel time from
+        the reach that passed it. The total is kept for the reach downstream. Returns the total load,
+        (mass.../runoff, dates) """
+        if local is None:  # A lake outlet may hold reservoir load without scenarios of its own
+            local = self.local.fetch(reach, verbose=False)
+        total = np.array(local, dtype=self.local.dtype).astype(self.i.float_type)  # Routed as stored in the matrix
+        for upstream, travel_time in self.senders.get(reach, ()):
+            total[:, travel_time:] += self.totals.fetch(upstream)[:, :self.i.n_dates - travel_time]
+        self.totals.update(reach, total)
+        return total
 
     def upstream_loading(self, reach):
-        """ Identify all upstream reaches, pull data and offset in time """
-        from .parameters import time_of_travel
+        """ Identify all upstream reaches, pull data and convolve it with the gamma impulse response of each travel
+        time. Only used with gamma convolution; otherwise loads are accumulated downstream. Returns the total mass and
+        runoff """
 
         # Fetch all upstream reaches and corresponding travel times
         reaches, times, warning = self.region.nav.upstream_watershed(reach)
-        indices = np.int16([i for i, r in enumerate(reaches) if r not in self.region.run_reaches])
+        batch = self.batch.get(reach, 0)  # Reaches in earlier batches have been passed through a reservoir
+        indices = np.int16([i for i, r in enumerate(reaches) if self.batch.get(r, batch) >= batch])
         reaches, times = reaches[indices], times[indices]
 
         if len(reaches) > 1:  # Don't need to do this if it's a headwater
-            # JCH - Check here to confirm that all upstream reaches have been processed?
             mass_and_runoff, index = self.local.fetch_multiple(reaches, return_index=True)  # (reaches, vars, dates)
             if index is not None:
                 reaches, times = reaches[index], times[index]
-            totals = np.zeros((2, self.i.n_dates))  # (mass/runoff, dates)
-            for tank in range(np.max(times) + 1):
-                in_tank = mass_and_runoff[times == tank].sum(axis=0)
-                if tank > 0:
-                    if time_of_travel.gamma_convolve:
-                        irf = self.region.irf.fetch(tank)  # Get the convolution function
-                        in_tank[0] = np.convolve(in_tank[0], irf)[:self.i.n_dates]  # mass
-                        in_tank[1] = np.convolve(in_tank[1], irf)[:self.i.n_dates]  # runoff
-                    else:
-                        in_tank = np.pad(in_tank[:, :-tank], ((0, 0), (tank, 0)), mode='constant')
-                totals += in_tank  # Add the convolved tank time series to the total for the reach
-            mass, runoff = totals
+            totals = np.zeros(self.local.shape[1:], dtype=self.i.float_type)  # (mass.../runoff, dates)
+            times = times.astype(np.int64)
+
+            # Group upstream reaches into tanks by travel time. Each tank is transformed once and multiplied by the
+            # cached transform of its impulse response, and the sum is transformed back once for the reach
+            tanks, tank_index = np.unique(times, return_inverse=True)
+            in_tanks = np.zeros((tanks.size,) + totals.shape, dtype=totals.dtype)
+            group_tanks(mass_and_runoff, tank_index, in_tanks)
+            irf = self.i.irf
+            spectrum = 0
+            for tank, in_tank in zip(tanks, in_tanks):  # mass for each chemical, runoff
+                spectrum = spectrum + np.fft.rfft(in_tank, irf.fft_length) * irf.transform(tank)
+            totals[:] = np.fft.irfft(spectrum, irf.fft_length)[:, :self.i.n_dates]
+            return totals[:-1], totals[-1]
         else:
-            mass, runoff = self.local.fetch(reach)
+            local = self.local.fetch(reach)
+            return local[:-1], local[-1]
 
+    def reach_concentration(self, reach, mass, runoff):
+        """ Compute the concentration in a reach from the total mass and runoff reaching it """
         flow = self.region.flow_file.flows(reach, self.i.month_index)
         if flow is not None:
             total_flow, (concentration, runoff_conc) = \
-                compute_concentration(mass, runoff, self.i.n_dates, flow)
+                compute_concentration(mass, runoff, self.i.n_dates, flow, self.i.float_type)
             return total_flow, runoff, mass, concentration
         else:
             return None, None, None, None
 
 
+class ScenarioCache(object):
+    """
+    An on-disk cache of processed scenario mass matrices. Entries are addressed by a hash of everything that
+    scenario processing depends on, and the least recently used entries are removed to keep the cache within budget
+    """
+
+    stale_age = 24.  # Hours after which an unfinished entry is assumed to be abandoned
+
+    def __init__(self, cache_dir, budget):
+        self.dir = cache_dir
+        self.budget = int(budget * 1024 ** 3)  # GB -> bytes
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+    @classmethod
+    def key(cls, *components):
+        sha = hashlib.sha1()
+        for component in components:
+            cls.digest(sha, component)
+        return sha.hexdigest()
+
+    @classmethod
+    def digest(cls, sha, component):
+        """ Add a component to a hash. Arrays are hashed by their full contents, and lists and tuples item by item, so
+        that arrays inside them are not reduced to their (rounded and abbreviated) printed form """
+        if isinstance(component, np.ndarray):
+            if component.dtype == object:  # Hash the values, not the addresses of the objects
+                component = component.astype(str)
+            sha.update(str((component.dtype, component.shape)).encode())
+            sha.update(np.ascontiguousarray(component).tobytes())
+        elif isinstance(component, (list, tuple)):
+            sha.update("{}[{}]".format(type(component).__name__, len(component)).encode())
+            for item in component:
+                cls.digest(sha, item)
+        else:
+            sha.update(repr(component).encode())
+
+    def entry_path(self, key):
+        return os.path.join(self.dir, key + ".dat")
+
+    def fetch(self, key):
+        """ Return the path of a cached entry, or None if the key has not been cached """
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            os.utime(path)  # Mark as recently used
+            return path
+
+    def reserve(self, key, size):
+        """ Make room for a new entry and return a temporary path to write it to. Each run writes its own temporary
+        file, so runs of the same inputs at the same time don't write over each other. Returns None if the entry
+        is larger than the entire cache """
+        if size > self.budget:
+            print("Processed scenarios ({:.1f} GB) exceed the cache budget".format(size / 1024 ** 3))
+            return None
+        self.evict(size)
+        self.remove_stale()
+        handle, temp_path = mkstemp(suffix=".tmp", prefix=key + "_", dir=self.dir)
+        try:
+            os.ftruncate(handle, size)
+        finally:
+            os.close(handle)
+        return temp_path
+
+    def commit(self, key, temp_path):
+        """ Move a completed entry into the cache. If another run has already cached the same entry, it is kept and
+        the temporary file is discarded """
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)
+        else:
+            os.replace(temp_path, path)
+        return path
+
+    def remove_stale(self):
+        """ Remove temporary files left behind by runs that did not finish. Files that are still being written are
+        recent, so only those which have not been modified for stale_age hours are removed """
+        cutoff = time.time() - self.stale_age * 3600
+        for f in os.listdir(self.dir):
+            path = os.path.join(self.dir, f)
+            try:
+                if f.endswith(".tmp") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:  # Removed by another run
+                pass
+
+    def entries(self):
+        """ All complete entries, least recently used first """
+        paths = [os.path.join(self.dir, f) for f in os.listdir(self.dir) if f.endswith(".dat")]
+        return sorted(paths, key=os.path.getmtime)
+
+    def evict(self, size):
+        """ Remove least recently used entries until there is room for a new entry of the given size """
+        entries = self.entries()
+        in_use = sum(map(os.path.getsize, entries))
+        for path in entries:
+            if in_use + size <= self.budget:
+                break
+            in_use -= os.path.getsize(path)
+            try:
+                os.remove(path)
+            except PermissionError:
+                print("Unable to get permission to remove cached scenarios {}".format(path))
+
+
+class ApplicationCalendar(object):
+    """
+    Pesticide application events for each chemical and each unique combination of crop and plant dates. Each calendar
+    is computed once and shared by all scenarios with the same pattern. Events are stored as (day, canopy, mass) in
+    order of day.
+    """
+
+    def __init__(self, applications, new_years, n_dates):
+        self.applications = applications  # One application matrix for each chemical
+        self.new_years = new_years
+        self.n_dates = n_dates
+        self.calendars = {}
+
+        # Chemicals with identical applications (e.g., samples of a parameter sweep) share calendars
+        unique = {}
+        self.application_index = np.int32([unique.setdefault(a.tobytes(), chemical)
+                                           for chemical, a in enumerate(applications)])
+
+    def create(self, chemical, crop, plant_dates):
+        application_mass = \
+            pesticide_to_field(self.applications[chemical], self.new_years, crop, plant_dates, self.n_dates)
+        days, canopy = np.nonzero(application_mass.T)
+        return days, canopy, application_mass[canopy, days]
+
+    def fetch(self, crops, plant_dates):
+        """ Returns the calendar index of each scenario and chemical, and the events of all calendars as flat arrays
+        with the bounds of each calendar """
+        applications, chemical_index = np.unique(self.application_index, return_inverse=True)
+        patterns, pattern_index = np.unique(np.column_stack((crops, plant_dates)), axis=0, return_inverse=True)
+        events = []
+        for crop, *dates in patterns:
+            for chemical in applications:
+                key = (chemical, crop, *dates)
+                if key not in self.calendars:
+                    self.calendars[key] = self.create(chemical, crop, np.array(dates, dtype=plant_dates.dtype))
+                events.append(self.calendars[key])
+        days, canopy, mass = (np.concatenate(e) for e in zip(*events))
+        bounds = np.cumsum([0] + [e[0].size for e in events])
+        calendars = pattern_index.reshape(-1, 1) * applications.size + chemical_index.ravel()
+        return calendars, (bounds, np.int64(days), np.int64(canopy), mass)
+
+
+class ProcessedMatrix(object):
+    """
+    Processed scenario data with the configuration (scenario, [runoff, erosion], [water/soil, mass...], date), where
+    mass is given for each chemical. With a single chemical, this is (scenario, [runoff, runoff_mass, erosion,
+    erosion_mass], date). Pesticide mass is only stored for scenarios with a treated crop. Runoff and erosion are not
+    copied, and are read from the input scenario matrix as they are requested. If a processor is given, pesticide mass
+    is computed the first time a scenario is requested by passing the rows of the mass matrix to the processor.
+    """
+
+    def __init__(self, array_matrix, treated, overlay, start_offset, end_offset, n_dates, n_chemicals=1, path=None,
+                 processor=None):
+        self.array_matrix = array_matrix
+        self.start_offset, self.end_offset = start_offset, end_offset
+        self.n_dates = n_dates
+        self.n_chemicals = n_chemicals
+        self.shape = (array_matrix.shape[0], 2, n_chemicals + 1, n_dates)
+        self.lookup = array_matrix.lookup
+
+        # Index of each scenario in the mass matrix. -1 indicates that the scenario is not treated
+        self.mass_index = np.full(self.shape[0], -1, dtype=np.int64)
+        self.mass_index[treated] = np.arange(treated.size)
+
+        # Overlay scenarios contribute pesticide mass but no runoff or erosion
+        self.overlay = np.zeros(self.shape[0], dtype=bool)
+        self.overlay[overlay] = True
+
+        # Initialize matrix of runoff and erosion mass for treated scenarios. When processing on demand, only the
+        # scenarios that recipes request are written, so disk space is not reserved for the rest
+        self.mass_matrix = MemoryMatrix([treated.size, 2, n_chemicals, n_dates], path=path,
+                                        sparse=processor is not None)
+
+        # Rows of the mass matrix that have been processed, if processing on demand
+        self.processor = processor
+        self.processed = np.zeros(treated.size, dtype=bool) if processor is not None else None
+
+    def fetch_multiple(self, indices, copy=False, verbose=False, aliased=True, return_index=False, dates=None):
+
+        # If selecting by aliases, get indices for aliases
+        index = None
+        if aliased:
+            addresses = self.lookup.rows(indices)
+            found = np.where(addresses >= 0)[0]
+            if found.size < len(indices):
+                index = found
+                if verbose:
+                    print("Missing {} of {} scenarios".format(len(indices) - found.size, len(indices)))
+            indices = addresses[found]
+        indices = np.asarray(indices)
+
+        # Runoff and erosion come from the input scenario matrix, which starts before the simulation dates
+        start, end, _ = (slice(None) if dates is None else dates).indices(self.n_dates)
+        out_array = np.zeros((indices.size,) + self.shape[1:-1] + (end - start,), dtype=np.float32)
+        out_array[:, :, 0] = self.array_matrix.fetch_multiple(indices, copy=True, aliased=False, columns=[1, 2],
+                                                              dates=slice(self.start_offset + start,
+                                                                          self.start_offset + end))
+        out_array[self.overlay[indices], :, 0] = 0.
+
+        # Runoff mass and erosion mass only exist for treated scenarios
+        mass_index = self.mass_index[indices]
+        treated = mass_index >= 0
+        if treated.any():
+            if self.processor is not None:
+                self.process(mass_index[treated])
+            out_array[treated, :, 1:] = self.mass_matrix.fetch_multiple(mass_index[treated], aliased=False,
+                                                                        dates=slice(start, end))
+
+        if return_index:
+            return out_array, index
+        else:
+            return out_array
+
+    def process(self, rows, chunk=2500):
+        """ Process the rows of the mass matrix which have not yet been processed, a chunk of rows at a time """
+        rows = np.unique(rows)
+        rows = rows[~self.processed[rows]]
+        for start in range(0, rows.size, chunk):
+            self.processor(rows[start:start + chunk])
+            self.processed[rows[start:start + chunk]] = True
+
+
+class ScenarioCatalog(object):
+    """
+    Integer codes for the crop, weather station, soil and region of each scenario, parsed once from the scenario IDs.
+    The catalog is saved next to the scenario key file with the ID format and a hash of the scenario IDs it was parsed
+    from, and is reused by later runs as long as both match. Codes that are not found in a scenario ID are -1.
+    """
+    dtype = np.dtype([('crop', np.int32), ('weather', np.int32), ('soil', np.int64), ('region', np.int32)])
+
+    def __init__(self, names, region, path, keyfile_path):
+        from .parameters import scenario_processing
+
+        self.path = path
+        self.region = int(region) if str(region).isdigit() else -1
+        id_format = scenario_processing.id_format
+        names_hash = hashlib.sha1("\n".join(map(str, names)).encode()).hexdigest()
+
+        # Use the saved catalog if it was built from the current key file, scenario IDs and ID format
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(keyfile_path):
+            try:
+                with np.load(path, allow_pickle=False) as saved:
+                    if str(saved['id_format']) == id_format and str(saved['names_hash']) == names_hash:
+                        self.array = saved['catalog']
+                        if self.array.dtype == self.dtype and self.array.size == len(names):
+                            return
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                pass  # An unreadable catalog is rebuilt
+        self.array = self.build(names)
+        try:
+            replace_file(path, lambda f: np.savez(f, catalog=self.array, id_format=id_format, names_hash=names_hash))
+        except OSError:
+            print("Unable to save scenario catalog to {}".format(path))
+
+    def __getitem__(self, field):
+        return self.array[field]
+
+    def build(self, names):
+        from .parameters import scenario_processing
+
+        id_format = re.compile(scenario_processing.id_format)
+        catalog = np.full(len(names), -1, dtype=self.dtype)
+        catalog['region'] = self.region
+        for n, name in enumerate(names):
+            match = id_format.search(name)
+            if match is None:
+                raise ValueError("Scenario ID {} does not match the format {}".format(name, id_format.pattern))
+            for field, value in match.groupdict().items():
+                if value is not None:
+                    catalog[field][n] = int(value)
+        return catalog
+
+
 class Scenarios(object):
-    def __init__(self, i, region, input_memmap_path, active_reaches='all', recipe_map=None, retain=None):
-        self.i = i
+    def __init__(self, i, region, input_memmap_path, active_reaches='all', recipe_map=None, cache=None):
+        from .parameters import scenario_processing, paths, soil, plant, ParameterSet
+
+        # Multiple chemicals with the same region and dates may be processed together
+        self.chemicals = i if isinstance(i, list) else [i]
+        self.i = self.chemicals[0]
+
+        # Soil and plant parameters are copied when the scenarios are set up, and carried to worker processes with the
+        # scenarios. Workers would otherwise see the defaults, not values changed at run time
+        self.soil, self.plant = ParameterSet(vars(soil)), ParameterSet(vars(plant))
 
         # JCH - temporary, for demo
         if region == 'mtb':
            region = '07'
 
+        self.region = region
         self.path = os.path.join(input_memmap_path, "region_" + region)
-        self.keyfile_path = self.path + "_key.txt"
+        self.container_path = self.path + "_arrays.mtx"
+        self.keyfile_path = self.container_path if os.path.exists(self.container_path) else self.path + "_key.txt"
         self.active_reaches = active_reaches
         self.recipe_map = recipe_map
 
@@ -607,23 +1733,80 @@ class Scenarios(object):
         if active_reaches != 'all' and self.recipe_map is not None:
             self.names = self.confine()
 
-        # Initialize input matrices
-        self.array_matrix = \
-            MemoryMatrix([self.names, self.arrays, self.n_dates], path=self.path + "_arrays.dat", existing=True)
-        self.variable_matrix = \
-            MemoryMatrix([self.names, self.variables], path=self.path + "_vars.dat", existing=True)
-
-        # Initialize empty matrix for procesed scenarios
-        process = retain is None or not os.path.exists(retain)
-        self.processed_matrix = MemoryMatrix([self.names, 4, i.n_dates], path=retain)
-        if process:
+        # Initialize input matrices. Scenario arrays may be stored compressed
+        if os.path.exists(self.path + "_arrays.zdat"):
+            self.array_matrix = CompressedMatrix([self.names, self.arrays, self.n_dates],
+                                                 path=self.path + "_arrays.zdat",
+                                                 cache_size=scenario_processing.compressed_cache)
+        elif self.keyfile_path == self.container_path:
+            self.array_matrix = MemoryMatrix.load(self.container_path, read_ahead=True)
+        else:
+            self.array_matrix = MemoryMatrix([self.names, self.arrays, self.n_dates], path=self.path + "_arrays.dat",
+                                             existing=True, read_ahead=True)
+        if self.keyfile_path == self.container_path:
+            self.variable_matrix = MemoryMatrix.load(self.path + "_vars.mtx")
+        else:
+            self.variable_matrix = \
+                MemoryMatrix([self.names, self.variables], path=self.path + "_vars.dat", existing=True)
+
+        # Get crop ID of each scenario and identify the scenarios with a crop that receives pesticide
+        self.catalog = ScenarioCatalog(self.names, self.region, self.path + "_catalog.npz", self.keyfile_path)
+        self.crops = self.catalog['crop']
+        treated_crops = set().union(*(chemical.crops for chemical in self.chemicals))
+        self.treated = np.where(np.isin(self.crops, sorted(treated_crops)))[0]
+
+        # Application calendars are shared by all scenarios with the same crop and plant dates
+        self.calendar = ApplicationCalendar([c.applications.astype(self.i.float_type) for c in self.chemicals],
+                                            self.i.new_year, self.i.n_dates)
+
+        # If the scenario is an overlay, runoff and erosion are not to be added to totals
+        if self.i.read_overlay:
+            self.overlay = self.treated[self.variable_matrix.fetch_multiple(self.treated, aliased=False)[:, 3] == 1]
+        else:
+            self.overlay = np.array([], dtype=np.int64)
+
+        # Look for processed scenarios from a previous run with the same inputs
+        if cache is None and scenario_processing.cache:
+            cache = ScenarioCache(paths.scenario_cache_path, scenario_processing.cache_budget)
+        self.cache_key = self.hash_inputs() if cache is not None else None
+        path = cache.fetch(self.cache_key) if cache is not None else None
+        process = path is None
+
+        # In lazy mode, scenarios are processed as recipes request them. The cache only holds fully processed
+        # matrices, so a lazy run does not add to it
+        lazy = process and scenario_processing.lazy
+        if process and not lazy and cache is not None:
+            size = self.treated.size * 2 * len(self.chemicals) * self.i.n_dates * np.dtype(np.float32).itemsize
+            path = cache.reserve(self.cache_key, size)
+
+        # Initialize empty matrix for processed scenarios. Pesticide mass is only stored for treated scenarios
+        self.processed_matrix = ProcessedMatrix(self.array_matrix, self.treated, self.overlay, self.start_offset,
+                                                self.end_offset, self.i.n_dates, len(self.chemicals), path=path,
+                                                processor=self.process_block if lazy else None)
+        if lazy:
+            print("Processing scenarios on demand")
+        elif process:
             self.process_scenarios()
+            if path is not None:
+                self.processed_matrix.mass_matrix.close()
+                self.processed_matrix.mass_matrix.path = cache.commit(self.cache_key, path)
+        else:
+            print("Using cached processed scenarios")
 
     def confine(self):
         years = sorted((k[1] for k in self.recipe_map.map.keys()))
         names = {s for y in years for r in self.active_reaches for sc, _ in self.recipe_map.fetch(r, y) for s in sc}
         return sorted(names)
 
+    def hash_inputs(self):
+        """ Create a key that identifies everything that the processed scenarios depend on """
+        scenario_files = [self.keyfile_path, self.array_matrix.path, self.variable_matrix.path]
+        file_versions = [(os.path.getsize(f), os.stat(f).st_mtime_ns) for f in scenario_files]
+        chemicals = [(c.koc, c.kd_flag, c.deg_aqueous, c.applications) for c in self.chemicals]
+        return ScenarioCache.key(self.region, file_versions, self.names, chemicals, str(self.i.sim_date_start),
+                                 str(self.i.sim_date_end), self.i.read_overlay, str(self.i.float_type),
+                                 sorted(vars(self.soil).items()), sorted(vars(self.plant).items()))
+
     def date_offsets(self):
         if self.start_date > self.i.sim_date_start:
             self.i.sim_date_start = self.start_date
@@ -638,148 +1821,203 @@ class Scenarios(object):
         return start_offset, end_offset
 
     def load_key(self):
+        """ Read the labels and shape of the scenario matrices from their containers. Scenario names are mapped, not
+        read, until they are used. Matrices in the older format are described by a text key file """
+        if self.keyfile_path == self.container_path:
+            arrays, variables = MatrixContainer(self.container_path), MatrixContainer(self.path + "_vars.mtx")
+            return arrays.attributes['arrays'], variables.attributes['variables'], arrays.labels, \
+                np.array(arrays.shape), np.array(variables.shape), np.datetime64(arrays.attributes['start_date']), \
+                int(arrays.shape[2])
         with open(self.keyfile_path) as f:
             arrays, variables, scenarios = (next(f).strip().split(",") for _ in range(3))
             start_date = np.datetime64(next(f).strip())
             shape = np.array([int(val) for val in next(f).strip().split(",")])
         return arrays, variables, np.array(scenarios), shape[:3], shape[3:], start_date, int(shape[2])
 
-    def process_scenarios(self, chunk=2500, progress_interval=5000):
-
-        from .parameters import soil, plant
-
-        # Initialize readers and writers
-        # Reminder: array_matrix.shape, processed_matrix.shape = (scenario, variable, date)
-        array_reader, variable_reader = self.array_matrix.reader, self.variable_matrix.reader
-        processed_writer = self.processed_matrix.writer
-
-        #tracemalloc.start()
-        # Iterate scenarios
-        for n, scenario_id in enumerate(self.names):
-
-            # TODO: Split scenario into multiple loops where each loop stores the results in a database that are
-            # merged after completion (reducing memory requirements), allowing for removal of the following two lines.
-            #if n == 25000:
-            #    break
-
-            # Report progress and reset readers/writers at intervals
-            if not (n + 1) % progress_interval:
-                #collect_stats()
-                print("{}/{}".format(n + 1, len(self.names)))
-                #tracemalloc.stop()
-                #tracemalloc.start()
-
-            # Open and close read/write cursors at intervals. This seems to help
-            if not n % chunk:
-                if n != 0:
-                    del array_reader, variable_reader, processed_writer
-                    array_reader, variable_reader = self.array_matrix.reader, self.variable_matrix.reader
-                    processed_writer = self.processed_matrix.writer
-
-            # Get crop ID of scenario and find all associated crops in group
-            crop = int(scenario_id.split("cdl")[1])
-
-            if crop in self.i.crops:
-
-                # Read non-sequential variables from scenario and process
-                if self.i.read_overlay:
-                    covmax, org_carbon, bulk_density, overlay, *plant_dates = variable_reader[n]
-                else:
-                    overlay = None
-
-                    covmax, org_carbon, bulk_density, *plant_dates = variable_reader[n]
-
-                # Extract arrays
-                leaching, runoff, erosion, soil_water, plant_factor, rain = \
-                    array_reader[n][:, self.start_offset:self.end_offset]
-
-                # Set kd depending on settings
-                kd = self.i.koc * org_carbon if self.i.kd_flag else self.koc
-
-                # Assert that all data is the proper shape for use in the functions
-                assert len(plant_dates) == 5, "Looking for 5 planting dates, found {}".format(len(plant_dates))
-                assert self.i.applications.shape[1] == 11, "Invalid application matrix, should have 11 columns"
-
-                # Calculate the daily input of pesticide to the soil and plant canopy
-                application_mass = \
-                    pesticide_to_field(self.i.applications, self.i.new_year, crop, plant_dates, rain, n == 47646)
-
-                # Calculate the daily mass of pesticide in the soil
-                pesticide_mass_soil = pesticide_to_soil(application_mass, rain, plant_factor, soil.cm_2,
-                                                        plant.deg_foliar, plant.washoff_coeff, covmax)
-
-                # Determine the loading of pesticide into runoff and eroded sediment
-                runoff_mass, erosion_mass = \
-                    pesticide_to_water(pesticide_mass_soil, runoff, erosion, leaching, bulk_density, soil_water, kd,
-                                       self.i.deg_aqueous, soil.runoff_effic, soil.delta_x, soil.erosion_effic,
-                                       soil.soil_depth)
-
-                # If the scenario is an overlay, runoff and erosion are not to be added to totals
-                if overlay == 1:
-                    runoff[:] = 0.
-                    erosion[:] = 0.
-
-                # Write runoff, erosion, runoff mass and erosion mass to processed matrix
-                processed_writer[n] = runoff, runoff_mass, erosion, erosion_mass
-
-            else:
-                # Write runoff and erosion
-                processed_writer[n, [0, 2]] = array_reader[n][1:3, self.start_offset:self.end_offset]
-
-        del array_reader, variable_reader
+    def process_scenarios(self, n_workers=None):
+
+        from .parameters import scenario_processing, matrix_storage
+
+        if n_workers is None:
+            n_workers = scenario_processing.n_workers
+        n_workers = max(1, min(n_workers, self.treated.size))
+        if n_workers > 1 and self.processed_matrix.mass_matrix.backend == 'ram':
+            print("Processed scenarios are held in process memory, which workers cannot share. Using 1 worker")
+            n_workers = 1
+
+        # Split the treated scenarios into contiguous shards, one per worker. Each worker reads its own rows of the
+        # input matrices and writes a disjoint set of rows to the processed matrix. Workers are given the storage
+        # settings of this process
+        bounds = np.linspace(0, self.treated.size, n_workers + 1).astype(int)
+        shards = [(start, end, dict(vars(matrix_storage))) for start, end in zip(bounds[:-1], bounds[1:])]
+
+        # Workers are spawned rather than forked, since the numba thread pool is not fork-safe. The numba threads
+        # available to this process are divided among the workers
+        if n_workers > 1:
+            n_threads = max(1, numba.get_num_threads() // n_workers)
+            with get_context("spawn").Pool(n_workers, initializer=start_scenario_worker,
+                                           initargs=(n_threads, workspace())) as pool:
+                pool.starmap(self.process_shard, shards)
+        else:
+            self.process_shard(*shards[0])
+
+    def process_shard(self, start, end, storage=None, chunk=2500, progress_interval=5000):
+        """ Process treated scenarios start:end, in order of the treated index. In a worker process, 'storage' gives
+        the matrix storage settings of the main process """
+        from .parameters import matrix_storage
+
+        if storage is not None:
+            matrix_storage.__dict__.update(storage)
+
+        # Stream chunks of scenarios through the input matrix. Pages of the input and processed matrices which have
+        # been used are released as the scan moves on, which keeps the resident size of large regions bounded.
+        # The next chunk is read while the current one is processed, and each processed chunk is written out on a
+        # writer thread while the next one is processed
+        mass_matrix = self.processed_matrix.mass_matrix
+        scan = self.array_matrix.scan(self.treated[start:end], chunk)
+        chunks = (slice(start + block.start, start + block.stop) for block, _ in scan)
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            written = None
+            for rows, inputs in prefetch(self.read_block, chunks):
+                out = self.compute_block(rows, inputs)
+                if written is not None:
+                    written.result()
+                written = writer.submit(self.write_block, rows, out, True)
+
+                # Report progress at intervals
+                if (rows.stop - start) // progress_interval > (rows.start - start) // progress_interval:
+                    print("{}/{}".format(rows.stop - start, end - start))
+            if written is not None:
+                written.result()
+
+    def process_block(self, rows):
+        """ Process a block of treated scenarios, given as a slice or an array of rows in the treated index """
+        self.write_block(rows, self.compute_block(rows, self.read_block(rows)))
+
+    def read_block(self, rows):
+        """ Read the input arrays, variables and application calendars of a block of treated scenarios """
+
+        # Reminder: array_matrix.shape = (scenario, variable, date)
+        first_date = 4 if self.i.read_overlay else 3
+        scenario_index = self.treated[rows]
+        arrays = self.array_matrix.fetch_multiple(scenario_index, aliased=False)
+        arrays = arrays[:, :, self.start_offset:self.end_offset]
+        variables = self.variable_matrix.fetch_multiple(scenario_index, aliased=False)
+        plant_dates = variables[:, first_date:first_date + 5]
+        calendars, calendar_events = self.calendar.fetch(self.crops[scenario_index], plant_dates)
+        return arrays, variables, calendars, calendar_events
+
+    def compute_block(self, rows, inputs):
+        """ Compute runoff and erosion mass for a block of treated scenarios. Contiguous blocks are computed directly
+        into the processed matrix, and None is returned. Otherwise, the processed block is returned """
+        soil, plant = self.soil, self.plant
+
+        arrays, variables, calendars, calendar_events = inputs
+
+        # Assert that all data is the proper shape for use in the functions
+        first_date = 4 if self.i.read_overlay else 3
+        n_plant_dates = self.variable_matrix.shape[1] - first_date
+        assert n_plant_dates == 5, "Looking for 5 planting dates, found {}".format(n_plant_dates)
+        for chemical in self.chemicals:
+            assert chemical.applications.shape[1] == 11, "Invalid application matrix, should have 11 columns"
+
+        # Chemical properties. kd is set depending on settings
+        kd_flag = np.array([bool(c.kd_flag) for c in self.chemicals])
+        koc, deg_aqueous = (np.array([getattr(c, p) for c in self.chemicals], dtype=self.i.float_type)
+                            for p in ('koc', 'deg_aqueous'))
+
+        # mass_matrix.shape = (treated, [runoff_mass, erosion_mass], chemical, date)
+        mass_writer = self.processed_matrix.mass_matrix.writer
+        out = mass_writer[rows] if isinstance(rows, slice) else \
+            np.zeros((arrays.shape[0],) + mass_writer.shape[1:], dtype=mass_writer.dtype)
+        process_scenario_block(arrays, variables, calendars, *calendar_events, kd_flag, koc, deg_aqueous,
+                               soil.cm_2, plant.deg_foliar, plant.washoff_coeff, soil.runoff_effic,
+                               soil.delta_x, soil.erosion_effic, soil.soil_depth, np.asarray(out))
+        return None if isinstance(rows, slice) else out
+
+    def write_block(self, rows, out, release=False):
+        """ Write a processed block to the processed matrix and flush it. If release is set, the rows of the block
+        are then released from memory """
+        mass_matrix = self.processed_matrix.mass_matrix
+        if out is not None:
+            mass_matrix.writer[rows] = out
+        mass_matrix.flush()
+        if release:
+            mass_matrix.release(rows.start, rows.stop)
 
 
 class Outputs(object):
     def __init__(self, i, scenario_ids, output_path, geometry, feature_type, demo_mode=False):
         logging.info("SAM TASK Generating Outputs... ")
-        self.i = i
+        self.chemicals = i if isinstance(i, list) else [i]
+        self.i = self.chemicals[0]
         self.geometry = geometry
         self.scenario_ids = scenario_ids
-        self.output_dir = os.path.join(output_path, i.token)
+        self.output_dir = os.path.join(output_path, self.i.token)
         self.feature_type = feature_type
         self.recipe_ids = sorted(self.geometry.index(self.feature_type))
         self.demo_mode = demo_mode
+        n_chemicals = len(self.chemicals)
+        # A parameter sweep is reduced to distributions of exceedance probability, and time series are not kept
+        self.sweep = self.i.n_samples > 1
         # Initialize output matrices
         self.output_fields = ['total_flow', 'total_runoff', 'total_mass', 'total_conc', 'benthic_conc']
-        self.time_series = MemoryMatrix([self.recipe_ids, self.output_fields, self.i.n_dates])
+        self.time_series = None if self.sweep else \
+            MemoryMatrix([self.recipe_ids, n_chemicals, self.output_fields, self.i.n_dates])
+        # Initialize exceedances matrix: probability of exceeding each endpoint, for each chemical
+        n_endpoints = max(chemical.endpoints.shape[0] for chemical in self.chemicals)
+        self.exceedances = MemoryMatrix([self.recipe_ids, n_chemicals, n_endpoints])
         # Initialize contributions matrix: loading data broken down by crop and runoff v. erosion source
-        self.exceedances = MemoryMatrix([self.recipe_ids, self.i.endpoints.shape[0]])
-        # Initialize contributions matrix: loading data broken down by crop and runoff v. erosion source
-        self.contributions = MemoryMatrix([self.recipe_ids, 2, self.i.crops])
-        self.contributions.columns = np.int32(sorted(self.i.crops))
+        crops = sorted(set().union(*(chemical.crops for chemical in self.chemicals)))
+        self.contributions = MemoryMatrix([self.recipe_ids, n_chemicals, 2, crops])
+        self.contributions.columns = np.int32(crops)
         self.contributions.header = ["cls" + str(c) for c in self.contributions.columns]
-        self.json_output = {}
+        # Rows are staged and written in bulk, and are flushed whenever the matrices are read
+        for matrix in (self.time_series, self.exceedances, self.contributions):
+            if matrix is not None:
+                matrix.buffered()
+        self.json_output = []
         logging.info("SAM Outputs Completed")
 
-    def update_contributions(self, recipe_id, scenario_index, loads):
+    def update_contributions(self, recipe_id, classes, loads):
         """ Sum the total contribution by land cover class and add to running total """
 
-        scenario_names = self.scenario_ids[scenario_index]
-        classes = [int(name.split("cdl")[1]) for name in scenario_names]
-        contributions = np.zeros((2, 255))
-        for i in range(2):  # Runoff Mass, Erosion Mass
-            contributions[i] += np.bincount(classes, weights=loads[i], minlength=255)
-        self.contributions.update(recipe_id, contributions[:, self.contributions.columns])
+        contributions = np.zeros((len(self.chemicals), 2, 255))
+        for chemical in range(len(self.chemicals)):
+            for i in range(2):  # Runoff Mass, Erosion Mass
+                contributions[chemical, i] += np.bincount(classes, weights=loads[i, chemical], minlength=255)
+        self.contributions.buffer.update(recipe_id, contributions[..., self.contributions.columns])
 
     def update_exceedances(self, recipe_id, concentration):
-        durations, endpoints = self.i.endpoints[["duration", "endpoint"]].as_matrix().T
-        exceed = exceedance_probability(concentration, *map(np.int16, (durations, endpoints, self.i.year_index)))
-        self.exceedances.update(recipe_id, exceed)
+        exceed = np.zeros(self.exceedances.shape[1:])
+        if self.sweep:  # All samples share endpoints, and are evaluated together
+            durations, endpoints = self.i.endpoints[["duration", "endpoint"]].as_matrix().T
+            exceed[:] = exceedance_probability(concentration, *map(np.int16, (durations, endpoints,
+                                                                              self.i.year_index)))
+        else:
+            for n, chemical in enumerate(self.chemicals):
+                durations, endpoints = chemical.endpoints[["duration", "endpoint"]].as_matrix().T
+                exceed[n, :durations.size] = exceedance_probability(
+                    concentration[n], *map(np.int16, (durations, endpoints, self.i.year_index)))
+        self.exceedances.buffer.update(recipe_id, exceed)
 
     def update_time_series(self, recipe_id, total_flow=None, total_runoff=None, total_mass=None, total_conc=None,
                            benthic_conc=None):
 
-        writer = self.time_series.writer
-        index = self.time_series.index.index(recipe_id)
+        if self.time_series is None:
+            return
+        if self.time_series.lookup.get(recipe_id) is None:
+            return
 
-        # This must match self.fields as designated in __init__
+        # This must match self.fields as designated in __init__. Flow and runoff are shared by all chemicals
+        series = np.zeros(self.time_series.shape[1:], dtype=self.time_series.dtype)
         rows = [total_flow, total_runoff, total_mass, total_conc, benthic_conc]
         for i, row in enumerate(rows):
             if row is not None:
-                writer[index, i] = row
-        del writer
+                series[:, i] = row
+        self.time_series.buffer.update(recipe_id, series)
 
-    def write_json(self, write_exceedances=False, write_contributions=False):
+    def write_json(self, write_exceedances=False, write_contributions=False, chemical=0):
 
         # Initialize JSON output
         encoder.FLOAT_REPR = lambda o: format(o, '.4f')
@@ -801,14 +2039,18 @@ class Outputs(object):
                                "geometry": {"type": "Point", "coordinates": coordinates},
                                "properties": new_feature}
 
-            # Add exceedance probabilities
-            if write_exceedances:
-                exceedance_dict = dict(zip(self.i.endpoints.short_name, map(float, self.exceedances.fetch(recipe_id))))
+            # Add exceedance probabilities. For a parameter sweep, add the distribution over all samples
+            if write_exceedances and self.sweep:
+                new_feature['properties'].update(self.exceedance_distribution(recipe_id))
+            elif write_exceedances:
+                exceedances = self.exceedances.fetch(recipe_id)[chemical]
+                exceedance_dict = dict(zip(self.chemicals[chemical].endpoints.short_name, map(float, exceedances)))
                 new_feature['properties'].update(exceedance_dict)
 
             # Add percent contributions
             if write_contributions:
                 contributions = self.contributions.fetch(recipe_id)
+                contributions = contributions.mean(axis=0) if self.sweep else contributions[chemical]
                 for i, category in enumerate(("runoff", "erosion")):
                     labels = ["{}_load_{}".format(category, label) for label in self.contributions.header]
                     contribution_dict = dict(zip(labels, map(float, contributions[i])))
@@ -819,12 +2061,24 @@ class Outputs(object):
 
         # Convert output dict to JSON object
         out_json = json.dumps(out_json, sort_keys=False, separators=(',', ':'))
-        self.json_output = json.loads(out_json)
+        self.json_output.append(json.loads(out_json))
 
         # Write to file
         # with open(out_file, 'w') as f:
         #     f.write(out_json)
 
+    def exceedance_distribution(self, recipe_id):
+        """ Summarize the exceedance probabilities of all samples in a parameter sweep by mean and percentiles """
+        from .parameters import sweep
+
+        exceedances = self.exceedances.fetch(recipe_id)
+        distribution = OrderedDict()
+        for name, samples in zip(self.i.endpoints.short_name, exceedances.T):
+            distribution["{}_mean".format(name)] = float(samples.mean())
+            for percentile, value in zip(sweep.percentiles, np.percentile(samples, sweep.percentiles)):
+                distribution["{}_p{}".format(name, percentile)] = float(value)
+        return distribution
+
     def write_demo(self, fields):
         # Initialize JSON output
         encoder.FLOAT_REPR = lambda o: format(o, '.4f')
@@ -855,7 +2109,7 @@ class Outputs(object):
 
         # Convert output dict to JSON object
         out_json = json.dumps(out_json, sort_keys=False, separators=(',', ':'))
-        self.json_output = json.loads(out_json)
+        self.json_output.append(json.loads(out_json))
 
         # Write to file
         # with open(out_file, 'w') as f:
@@ -885,12 +2139,14 @@ class Outputs(object):
                            ['pct_soy', 0.2],
                            ['pct_row', 0.1]]
 
-            self.write_demo(demo_fields)
+            for _ in ([self.i] if self.sweep else self.chemicals):
+                self.write_demo(demo_fields)
         else:
-            self.write_json(self.i.write_exceedances, self.i.write_contributions)
+            for chemical in range(1 if self.sweep else len(self.chemicals)):
+                self.write_json(self.i.write_exceedances, self.i.write_contributions, chemical)
 
         # Write time series
-        if self.i.write_time_series:
+        if self.i.write_time_series and self.time_series is not None:
             self.write_time_series()
 
     def write_time_series(self, fields='all'):
@@ -917,31 +2173,136 @@ class Outputs(object):
         headings = [heading_lookup.get(field, "N/A") for field in fields]
 
         for recipe_id in self.recipe_ids:
-            out_file = os.path.join(self.output_dir, "time_series_{}.csv".format(recipe_id))
-            out_data = self.time_series.fetch(recipe_id)[field_indices].T
-            df = pd.DataFrame(data=out_data, index=self.i.dates, columns=headings)
-            df.to_csv(out_file)
+            for n, chemical in enumerate(self.chemicals):
+                if len(self.chemicals) > 1:
+                    out_file = "time_series_{}_{}.csv".format(recipe_id, chemical.chemical_name)
+                else:
+                    out_file = "time_series_{}.csv".format(recipe_id)
+                out_data = self.time_series.fetch(recipe_id)[n, field_indices].T
+                df = pd.DataFrame(data=out_data, index=self.i.dates, columns=headings)
+                df.to_csv(os.path.join(self.output_dir, out_file))
 
 
 def initialize():
-    # Make sure needed subdirectories exist
-    preexisting_subdirs = ["Results", "temp"]
-    for subdir in preexisting_subdirs:
-        d = os.path.join("..", "bin", subdir)
-        if not os.path.exists(d):
-            os.makedirs(d)
-        else:
-            if subdir == 'temp':
-                for f in os.listdir(d):
-                    try:
-                        os.remove(os.path.join(d, f))
-                    except PermissionError:
-                        print("Unable to get permission to delete temp file")
+    """ Make sure needed subdirectories exist, and give the run a fresh scratch workspace, which is returned. Workspaces
+    of other runs in the process are left in place until they are released """
+    global _workspace
+    d = os.path.join("..", "bin", "Results")
+    if not os.path.exists(d):
+        os.makedirs(d)
+    _workspace = Workspace()
+    return _workspace
+
+
+class Workspace(object):
+    """ Scratch directory of a run under paths.scratch_path, named for the host, the process and a unique ID. A lock
+    file beside the directory is held for as long as the workspace is in use. Workspaces whose lock can be taken were
+    left by runs that have ended, on any host sharing the scratch path, and are removed when a new one is created.
+    Worker processes attach to the workspace of the main process, which is left for the main process to release """
+
+    legacy = re.compile(r"(run_.*|tmp.*\.dat)$")  # Scratch directories and files of versions without lock files
+
+    def __init__(self):
+        from .parameters import paths
+
+        os.makedirs(paths.scratch_path, exist_ok=True)
+        self.remove_stale(paths.scratch_path)
+        name = "run_{}_{}_{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.path = os.path.join(paths.scratch_path, name)
+        self.lock = self.take_lock(self.path + ".lock")
+        os.makedirs(self.path)
+        atexit.register(self.release)
+
+    @classmethod
+    def attach(cls, path):
+        """ Use an existing workspace without taking ownership of it """
+        attached = cls.__new__(cls)
+        attached.path, attached.lock = path, None
+        return attached
+
+    @staticmethod
+    def take_lock(lock_path):
+        """ Create and hold a lock file. If the file is removed by a cleanup before the lock is taken, it is made
+        again, so that the lock which is held is always the one other processes find """
+        while True:
+            lock = open(lock_path, "w")
+            if fcntl is None:
+                return lock
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except OSError:
+                pass
+            lock.close()
+
+    def release(self):
+        """ Delete the workspace and its lock file """
+        if self.lock is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            try:
+                os.remove(self.lock.name)
+            except OSError:
+                pass
+            self.lock.close()
+            self.lock = None
+
+    @classmethod
+    def remove_stale(cls, scratch_path):
+        """ Remove workspaces whose lock is free, and scratch directories and files without a lock file, which were
+        left by earlier versions. Without file locks there is no telling whether a workspace is in use, so all are
+        left in place """
+        if fcntl is None:
+            return
+        names = set(os.listdir(scratch_path))
+        for name in names:
+            path = os.path.join(scratch_path, name)
+            try:
+                if name.startswith("run_") and name.endswith(".lock"):
+                    with open(path, "a") as lock:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        shutil.rmtree(path[:-len(".lock")], ignore_errors=True)
+                        os.remove(path)
+                elif cls.legacy.match(name) and name + ".lock" not in names:
+                    # A workspace directory only exists while its lock file does
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+            except OSError:  # The lock is held by a live run, or the workspace was just removed by another
+                continue
+
+
+_workspace = None  # Workspace of the current run
+
+
+def workspace():
+    """ Return the scratch directory of the current run, creating a workspace if there is none """
+    global _workspace
+    if _workspace is None:
+        _workspace = Workspace()
+    return _workspace.path
+
+
+def attach_workspace(path):
+    """ Keep the scratch matrices of a worker process in the workspace of the main process at 'path' """
+    global _workspace
+    _workspace = Workspace.attach(path)
+
+
+def release_workspace(run_workspace=None):
+    """ Delete a scratch workspace, by default that of the current run """
+    global _workspace
+    run_workspace = run_workspace or _workspace
+    if run_workspace is _workspace:
+        _workspace = None
+    if run_workspace is not None:
+        run_workspace.release()
 
 
-@njit
+@njit(nogil=True)
 def benthic_loop(eroded_soil, erosion_mass, soil_volume):
-    benthic_mass = np.zeros(erosion_mass.size, dtype=np.float32)
+    benthic_mass = np.zeros(erosion_mass.size, dtype=erosion_mass.dtype)
     benthic_mass[0] = erosion_mass[0]
     for i in range(1, erosion_mass.size):
         influx_ratio = eroded_soil[i] / (eroded_soil[i] + soil_volume)
@@ -949,20 +2310,46 @@ def benthic_loop(eroded_soil, erosion_mass, soil_volume):
     return benthic_mass
 
 
-def compute_concentration(transported_mass, runoff, n_dates, q):
+@njit(nogil=True)
+def group_tanks(loads, tank_index, in_tanks):
+    """ Sum reach loads (reaches, vars, dates) into the travel time tanks they belong to """
+    for i in range(loads.shape[0]):
+        in_tanks[tank_index[i]] += loads[i]
+    return in_tanks
+
+
+@njit(parallel=True, nogil=True)
+def add_scenarios(scenarios, reaches, weights, data, local, erosion, days_per_thread=256):
+    """ Add weighted scenario data (scenarios, [runoff, erosion], [water/soil, mass...], dates) to the reaches that
+    include them. Local loads are stored as [mass..., runoff] and erosion as [erosion, mass...]. Threads each take a
+    range of dates, so that no two threads add to the same value """
+    n_values, n_dates = data.shape[2], data.shape[3]
+    for chunk in prange((n_dates + days_per_thread - 1) // days_per_thread):
+        first, last = chunk * days_per_thread, min((chunk + 1) * days_per_thread, n_dates)
+        for k in range(scenarios.size):
+            scenario, reach = scenarios[k], reaches[k]
+            for value in range(n_values):
+                local_value = (value - 1) % n_values  # Runoff is stored after the mass of each chemical
+                for day in range(first, last):
+                    local[reach, local_value, day] += weights[k, 0] * data[scenario, 0, value, day]
+                    erosion[reach, value, day] += weights[k, 1] * data[scenario, 1, value, day]
+
+
+def compute_concentration(transported_mass, runoff, n_dates, q, dtype=np.float64):
     """ Concentration function for time of travel """
     mean_runoff = runoff.mean()  # m3/d
-    baseflow = np.subtract(q, mean_runoff, out=np.zeros(n_dates), where=(q > mean_runoff))
+    baseflow = np.subtract(q, mean_runoff, out=np.zeros(n_dates, dtype=dtype), where=(q > mean_runoff))
     total_flow = runoff + baseflow
-    concentration = np.divide(transported_mass, total_flow, out=np.zeros(n_dates),
+    concentration = np.divide(transported_mass, total_flow, out=np.zeros(transported_mass.shape, dtype=dtype),
                               where=(total_flow != 0))
-    runoff_concentration = np.divide(transported_mass, runoff, out=np.zeros(n_dates),
+    runoff_concentration = np.divide(transported_mass, runoff, out=np.zeros(transported_mass.shape, dtype=dtype),
                                      where=(runoff != 0))
 
     return total_flow, map(lambda x: x * 1000000., (concentration, runoff_concentration))  # kg/m3 -> ug/L
 
 
-@guvectorize(['void(float64[:], int16[:], int16[:], int16[:], float64[:])'], '(p),(o),(o),(p)->(o)')
+@guvectorize(['void(float64[:], int16[:], int16[:], int16[:], float64[:])',
+              'void(float32[:], int16[:], int16[:], int16[:], float64[:])'], '(p),(o),(o),(p)->(o)', cache=True)
 def exceedance_probability(time_series, window_sizes, endpoints, years_since_start, res):
     # Count the number of times the concentration exceeds the test threshold in each year
     n_years = years_since_start.max()
@@ -980,6 +2367,19 @@ def exceedance_probability(time_series, window_sizes, endpoints, years_since_sta
         res[test_number] = exceedances.sum() / n_years
 
 
+def fft_length(n):
+    """ Smallest length of at least n with no prime factors above 5, for which FFTs are fast """
+    length = n
+    while True:
+        remainder = length
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return length
+        length += 1
+
+
 def impulse_response_function(alpha, beta, length):
     def gamma_distribution(t, a, b):
         a, b = map(float, (a, b))
@@ -994,11 +2394,11 @@ def impulse_response_function(alpha, beta, length):
     return np.array([gamma_distribution(i, alpha, beta) for i in range(length)])
 
 
-@njit
-def pesticide_to_field(applications, new_years, active_crop, event_dates, rain, diagnostic=False):
+@njit(nogil=True)
+def pesticide_to_field(applications, new_years, active_crop, event_dates, n_dates, diagnostic=False):
     """ Simulate timing of pesticide appplication to field """
 
-    application_mass = np.zeros((2, rain.size))
+    application_mass = np.zeros((2, n_dates), dtype=applications.dtype)
     for i in range(applications.shape[0]):
 
         crop, event, offset, canopy, step, window1, pct1, window2, pct2, effic, rate = applications[i]
@@ -1035,45 +2435,68 @@ def pesticide_to_field(applications, new_years, active_crop, event_dates, rain,
     return application_mass
 
 
-@njit
-def pesticide_to_soil(application_mass, rain, plant_factor, soil_2cm, foliar_degradation, washoff_coeff, covmax):
-    """ Calcluate pesticide in soil and simulate movement of pesticide from canopy to soil """
+@njit(nogil=True)
+def pesticide_to_soil(application_days, application_canopy, application_mass, rain, plant_factor, soil_2cm,
+                      foliar_degradation, washoff_coeff, covmax):
+    """ Calcluate pesticide in soil and simulate movement of pesticide from canopy to soil. Applications are
+    provided as events (day, canopy, mass) in order of day """
 
     # Initialize output
-    pesticide_mass_soil = np.zeros(rain.size)
+    pesticide_mass_soil = np.zeros(rain.size, dtype=application_mass.dtype)
     canopy_mass, last_application = 0, 0  # Running variables
 
     # Determine if any pesticide has been applied to canopy
-    canopy_applications = application_mass[1].sum() > 0
+    canopy_applications = False
+    for event in range(application_days.size):
+        if application_canopy[event] and application_mass[event] > 0:
+            canopy_applications = True
+
+    # Without canopy applications, pesticide goes directly to soil on application days
+    if not canopy_applications:
+        for event in range(application_days.size):
+            pesticide_mass_soil[application_days[event]] = application_mass[event] * soil_2cm
+        return pesticide_mass_soil
 
     # Loop through each day
+    event = 0
     for day in range(plant_factor.size):
+        soil_application, canopy_application = 0., 0.
+        while event < application_days.size and application_days[event] == day:
+            if application_canopy[event]:
+                canopy_application = application_mass[event]
+            else:
+                soil_application = application_mass[event]
+            event += 1
+
         # Start with pesticide applied directly to soil
-        pesticide_mass_soil[day] = application_mass[0, day] * soil_2cm
-        # If pesticide has been applied to the canopy, simulate movement from canopy to soil
-        if canopy_applications:
-            if application_mass[1, day] > 0:  # Pesticide applied to canopy on this day
-                canopy_pesticide_additions = application_mass[1, day] * plant_factor[day] * covmax
-                pesticide_mass_soil[day] += (application_mass[1, day] - canopy_pesticide_additions) * soil_2cm
-                canopy_mass = canopy_pesticide_additions + \
-                              canopy_mass * np.exp((day - last_application) * foliar_degradation)
-                last_application = day
-            if rain[day] > 0:  # Simulate washoff
-                canopy_mass *= np.exp((day - last_application) * foliar_degradation)
-                pesticide_remaining = canopy_mass * np.exp(-rain[day] * washoff_coeff)
-                pesticide_mass_soil[day] += canopy_mass - pesticide_remaining
-                last_application = day  # JCH - sure?
+        pesticide_mass_soil[day] = soil_application * soil_2cm
+
+        # Simulate movement of pesticide from canopy to soil
+        if canopy_application > 0:  # Pesticide applied to canopy on this day
+            canopy_pesticide_additions = canopy_application * plant_factor[day] * covmax
+            pesticide_mass_soil[day] += (canopy_application - canopy_pesticide_additions) * soil_2cm
+            canopy_mass = canopy_pesticide_additions + \
+                          canopy_mass * np.exp((day - last_application) * foliar_degradation)
+            last_application = day
+        if rain[day] > 0:  # Simulate washoff
+            canopy_mass *= np.exp((day - last_application) * foliar_degradation)
+            pesticide_remaining = canopy_mass * np.exp(-rain[day] * washoff_coeff)
+            pesticide_mass_soil[day] += canopy_mass - pesticide_remaining
+            last_application = day  # JCH - sure?
     return pesticide_mass_soil
 
 
-@njit
+@njit(nogil=True)
 def pesticide_to_water(pesticide_mass_soil, runoff, erosion, leaching, bulk_density, soil_water, kd, deg_aqueous,
-                       runoff_effic, delta_x, erosion_effic, soil_depth):
-    # Initialize output arrays
-    runoff_mass, erosion_mass = np.zeros(runoff.size), np.zeros(runoff.size)
+                       runoff_effic, delta_x, erosion_effic, soil_depth, runoff_mass, erosion_mass):
+    """ Calculate the daily mass of pesticide in runoff and eroded sediment for a set of chemicals or parameter
+    samples in one pass over the scenario. pesticide_mass_soil, runoff_mass and erosion_mass are (sample, date),
+    kd and deg_aqueous have one value per sample. Results are written to the runoff_mass and erosion_mass arrays """
 
     # Initialize running variables
-    total_mass, degradation_rate = 0, 0
+    n_samples = kd.size
+    total_mass = np.zeros(n_samples, dtype=pesticide_mass_soil.dtype)
+    degradation_rate = np.zeros(n_samples, dtype=pesticide_mass_soil.dtype)
 
     # Initialize erosion intensity
     erosion_intensity = erosion_effic / soil_depth
@@ -1081,24 +2504,68 @@ def pesticide_to_water(pesticide_mass_soil, runoff, erosion, leaching, bulk_dens
     # Loop through days
     for day in range(runoff.size):
         daily_runoff = runoff[day] * runoff_effic
-        total_mass = total_mass * degradation_rate + pesticide_mass_soil[day]
-        retardation = (soil_water[day] / delta_x) + (bulk_density * kd)
-        deg_total = deg_aqueous + ((daily_runoff + leaching[day]) / (delta_x * retardation))
-        if leaching[day] > 0:
-            degradation_rate = np.exp(-deg_total)
-        else:
-            degradation_rate = np.exp(-deg_aqueous)
-
-        average_conc = ((total_mass / retardation / delta_x) / deg_total) * (1 - degradation_rate)
+        enrich = np.exp(2.0 - (0.2 * np.log10(erosion[day]))) if erosion[day] > 0 else 0.
+        for n in range(n_samples):
+            total_mass[n] = total_mass[n] * degradation_rate[n] + pesticide_mass_soil[n, day]
+            retardation = (soil_water[day] / delta_x) + (bulk_density * kd[n])
+            deg_total = deg_aqueous[n] + ((daily_runoff + leaching[day]) / (delta_x * retardation))
+            if leaching[day] > 0:
+                degradation_rate[n] = np.exp(-deg_total)
+            else:
+                degradation_rate[n] = np.exp(-deg_aqueous[n])
 
-        if leaching[day] > 0:
-            runoff_mass[day] = average_conc * daily_runoff
-        if erosion[day] > 0:
-            enrich = np.exp(2.0 - (0.2 * np.log10(erosion[day])))
-            enriched_eroded_mass = erosion[day] * enrich * kd * erosion_intensity * 0.1
-            erosion_mass[day] = average_conc * enriched_eroded_mass
+            average_conc = ((total_mass[n] / retardation / delta_x) / deg_total) * (1 - degradation_rate[n])
 
-    return runoff_mass, erosion_mass
+            if leaching[day] > 0:
+                runoff_mass[n, day] = average_conc * daily_runoff
+            else:
+                runoff_mass[n, day] = 0.
+            if erosion[day] > 0:
+                enriched_eroded_mass = erosion[day] * enrich * kd[n] * erosion_intensity * 0.1
+                erosion_mass[n, day] = average_conc * enriched_eroded_mass
+            else:
+                erosion_mass[n, day] = 0.
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def process_scenario_block(arrays, variables, calendars, calendar_bounds, application_days, application_canopy,
+                           application_mass, kd_flag, koc, deg_aqueous, soil_2cm, foliar_degradation, washoff_coeff,
+                           runoff_effic, delta_x, erosion_effic, soil_depth, out):
+    """ Run the field-to-soil-to-water chain for a block of treated scenarios and write the runoff and erosion mass
+    to a preallocated output block. arrays: (scenario, array, date), variables: (scenario, variable),
+    out: (scenario, 2, chemical, date). Chemical properties are given as arrays with one value per chemical.
+    The application calendar of each scenario and chemical is given by calendars, which indexes the event bounds in
+    calendar_bounds """
+
+    for n in prange(arrays.shape[0]):
+
+        # Extract arrays
+        leaching, runoff, erosion, soil_water, plant_factor, rain = \
+            arrays[n, 0], arrays[n, 1], arrays[n, 2], arrays[n, 3], arrays[n, 4], arrays[n, 5]
+
+        # Read non-sequential variables from scenario
+        covmax, org_carbon, bulk_density = variables[n, 0], variables[n, 1], variables[n, 2]
+        kd = np.where(kd_flag, koc * org_carbon, koc)
+
+        # Calculate the daily mass of pesticide in the soil for each chemical. Chemicals with the same calendar share
+        # the result
+        pesticide_mass_soil = np.zeros((koc.size, rain.size), dtype=application_mass.dtype)
+        for chemical in range(koc.size):
+            calendar = calendars[n, chemical]
+            start, end = calendar_bounds[calendar], calendar_bounds[calendar + 1]
+            if start == end:  # Chemical is not applied to this crop
+                continue
+            if chemical > 0 and calendar == calendars[n, chemical - 1]:
+                pesticide_mass_soil[chemical] = pesticide_mass_soil[chemical - 1]
+            else:
+                pesticide_mass_soil[chemical] = \
+                    pesticide_to_soil(application_days[start:end], application_canopy[start:end],
+                                      application_mass[start:end], rain, plant_factor, soil_2cm, foliar_degradation,
+                                      washoff_coeff, covmax)
+
+        # Determine the loading of pesticide into runoff and eroded sediment for all chemicals at once
+        pesticide_to_water(pesticide_mass_soil, runoff, erosion, leaching, bulk_density, soil_water, kd, deg_aqueous,
+                           runoff_effic, delta_x, erosion_effic, soil_depth, out[n, 0], out[n, 1])
 
 
 if __name__ == "__main__":
@@ -18,7 +18,10 @@ path_params = {
     "flow_dir": os.path.join(path, "Preprocessed", "FlowFiles"),
     "lakefile_path": os.path.join(path, "Preprocessed", "LakeFiles"),
     "upstream_path": os.path.join(path, "Preprocessed", "Navigators"),
-    "geometry_path": os.path.join(path, "Preprocessed", "Geometry")
+    "geometry_path": os.path.join(path, "Preprocessed", "Geometry"),
+    "scenario_cache_path": os.path.join(path, "ScenarioCache"),
+    # Each run keeps its temporary matrices in its own workspace here, which may be placed on tmpfs or a local disk
+    "scratch_path": os.path.join(path, "temp")
 }
 
 """ Parameters below are hardwired model parameters """
@@ -40,6 +43,51 @@ soil_params = {
     "delx": 2.0,  # cm, one 2 cm compartment, MMF
 }
 
+# Scenario processing
+scenario_params = {
+    "n_workers": 1,  # Number of processes used to process scenarios. 1 processes all scenarios in the main process
+    "lazy": False,  # Process each scenario the first time a recipe requests it, rather than all scenarios up front
+    "cache": True,  # Reuse processed scenarios from previous runs with the same chemical, applications and dates
+    "cache_budget": 50.,  # Maximum disk space used by the processed scenario cache (GB)
+    "compressed_cache": 512.,  # Memory used to hold decompressed blocks of compressed scenario arrays (MB)
+    # Format of scenario IDs. Named groups give the integer codes stored in the scenario catalog
+    "id_format": r"(?P<soil>\d+)?(?:w(?P<weather>\d+))?cdl(?P<crop>\d+)"
+}
+
+# Recipe processing. Reaches are processed a level at a time, and the reaches in a level are divided among workers
+recipe_params = {
+    "n_workers": 1  # Number of processes used to process recipes. 1 processes all recipes in the main process
+}
+
+# Storage of scratch matrices (local loads, outputs, impulse response functions and uncached processed scenarios).
+# "file" uses temporary files, "ram" process memory and "shared" shared memory, which worker processes attach to.
+# "auto" uses shared memory (or process memory, if shared memory is unavailable) up to the memory budget
+matrix_storage_params = {
+    "backend": "auto",
+    "memory_budget": 4.,  # GB
+    "write_buffer": 16.,  # MB of rows staged by a RowBuffer before they are written together
+    "scan_window": 256.,  # MB of a file mapping kept resident behind a streaming scan
+    "local_block": 256.,  # MB of scenario data read at a time while recipes are summed into local loads
+    "prefetch": True,  # Read the next block of scenarios or recipe on a background thread while the current one is used
+    "preallocate": 64.  # MB. Disk space for matrix files at least this large is reserved when they are created (0: never)
+}
+
+# Floating point precision of the field and routing kernels. Storage matrices are float32 in either case.
+# "float32" keeps the whole pipeline in single precision. It is validated against "float64" with
+# Development/check_precision.py: concentrations agree within a relative tolerance of 1e-3 wherever they exceed 1e-6 of
+# the peak, and exceedance probabilities within one year of exceedance. Run the script on local data to measure the
+# errors for a region
+precision_params = {
+    "float_type": "float64"
+}
+
+# Parameter sweep. koc and soil_hl are swept as values. apprate_factor is a multiplier on the rate of every
+# application in the applications table (column 'apprate'), so applications with different rates keep their proportions
+sweep_params = {
+    "parameters": ("koc", "soil_hl", "apprate_factor"),  # Inputs which may be given as arrays of samples
+    "percentiles": (5, 50, 95)  # Percentiles of the exceedance probability distribution reported for each reach
+}
+
 # Time of Travel defaults
 time_of_travel_params = {
     "gamma_convolve": False,
@@ -71,6 +119,11 @@ benthic_params = {
 plant = ParameterSet(plant_params)
 soil = ParameterSet(soil_params)
 paths = ParameterSet(path_params)
+scenario_processing = ParameterSet(scenario_params)
+recipe_processing = ParameterSet(recipe_params)
+sweep = ParameterSet(sweep_params)
+precision = ParameterSet(precision_params)
+matrix_storage = ParameterSet(matrix_storage_params)
 time_of_travel = ParameterSet(time_of_travel_params)
 water_column = ParameterSet(water_column_params)
 benthic = ParameterSet(benthic_params)
@@ -1,53 +1,57 @@
 from .parameters import paths as p
-from .functions import InputParams, Hydroregion, Scenarios, Recipes, Outputs, initialize
+from .functions import InputParams, Hydroregion, Scenarios, Recipes, Outputs, initialize, release_workspace
 
 
 def pesticide_calculator(input_data):
 
     # Initialize file structure
-    initialize()
-
-    # Initialize parameters from front end
-    inputs = InputParams(input_data)
-
-    # Loop through all NHD regions included in selected runs
-    for region_id in inputs.active_regions:
-
-        # Load watershed topology maps and account for necessary files
-        print("Processing hydroregion {}...".format(region_id))
-        region = Hydroregion(region_id, inputs.sim_type, p.map_path, p.flow_dir, p.upstream_path, p.lakefile_path, p.geometry_path)
-
-        # Simulate application of pesticide to all input scenarios
-        print("Processing scenarios...")
-        # scenarios = Scenarios(inputs, region_id, p.input_scenario_path, region.active_reaches,
-        #                       retain=r"..\bin\deux")  # retain=r"..\bin\une"
-        scenarios = Scenarios(inputs, region_id, p.input_scenario_path, region.active_reaches,
-                              retain=None)
-
-        # Initialize output object
-        print("Initializing outputs...")
-        outputs = Outputs(inputs, scenarios.names, p.output_path, region.geometry, region.feature_type, demo_mode=True)
-        # outputs = Outputs(inputs, scenarios.names, p.output_path, region.geometry, region.feature_type, demo_mode=False)
-
-        # Cascade downstream processing watershed recipes and performing travel time analysis
-        for year in [2011]:  # manual years
-
-            print("Processing recipes for {}...".format(year))
-            recipes = Recipes(inputs, outputs, year, region, scenarios, p.output_path, region.active_reaches)
-
-            # Iterate through batches of reaches upstream of a reservoir
-            for reaches, lake in region.cascade():
-
-                # Process all the recipes in the batch
-                recipes.process_recipes(reaches)
-
-                # Modify all stored recipe data in the batch to simulate passage through reservoir
-                recipes.burn_reservoir(lake, reaches)
-
-        # Write output
-        print("Writing output...")
-        outputs.write_output()
-        return outputs.json_output
+    run_workspace = initialize()
+
+    # Temporary matrices are kept in a scratch workspace, which is removed when the run is done
+    try:
+        # Initialize parameters from front end. A list of inputs for the same region and dates is run as a batch
+        batch = isinstance(input_data, list)
+        inputs = [InputParams(chemical) for chemical in input_data] if batch else InputParams(input_data)
+        chemicals = inputs if batch else [inputs]
+        if any(chemical.n_samples > 1 for chemical in chemicals):
+            if batch:
+                raise ValueError("A parameter sweep must be run for a single chemical")
+            inputs = chemicals = inputs.samples()  # Each sample of a parameter sweep is run as a chemical
+        for chemical in chemicals[1:]:
+            if chemical.region != chemicals[0].region or not chemicals[0].dates.equals(chemical.dates):
+                raise ValueError("All chemicals in a batch must have the same region and simulation dates")
+
+        # Loop through all NHD regions included in selected runs
+        for region_id in chemicals[0].active_regions:
+
+            # Load watershed topology maps and account for necessary files
+            print("Processing hydroregion {}...".format(region_id))
+            region = Hydroregion(region_id, chemicals[0].sim_type, p.map_path, p.flow_dir, p.upstream_path, p.lakefile_path, p.geometry_path)
+
+            # Simulate application of pesticide to all input scenarios
+            print("Processing scenarios...")
+            scenarios = Scenarios(inputs, region_id, p.input_scenario_path, region.active_reaches)
+
+            # Initialize output object
+            print("Initializing outputs...")
+            outputs = Outputs(inputs, scenarios.names, p.output_path, region.geometry, region.feature_type, demo_mode=True)
+            # outputs = Outputs(inputs, scenarios.names, p.output_path, region.geometry, region.feature_type, demo_mode=False)
+
+            # Cascade downstream processing watershed recipes and performing travel time analysis
+            for year in [2011]:  # manual years
+
+                print("Processing recipes for {}...".format(year))
+                recipes = Recipes(inputs, outputs, year, region, scenarios, p.output_path, region.active_reaches)
+
+                # Burn reservoirs and process all recipes, a level of independent reaches at a time
+                recipes.process_region()
+
+            # Write output
+            print("Writing output...")
+            outputs.write_output()
+            return outputs.json_output if batch else outputs.json_output[0]
+    finally:
+        release_workspace(run_workspace)
 
 
 def main(input_data=None):